@@ -1,112 +1,2111 @@
 from flask import Flask, request, jsonify
 import requests
+import click
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import base64
+import json
+import re
+import tempfile
+import uuid
+import shutil
+import glob
+import sqlite3
+import contextvars
+import functools
+import hashlib
+import random
+from contextlib import closing, contextmanager
 import logging
+import logging.handlers
 import traceback
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 
 
 # 🚀 Создаём приложение
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
 
 # 🧩 Получаем токен и URL из переменных окружения
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 APPS_SCRIPT_URL = os.getenv("APPS_SCRIPT_URL")
 COMPANY_SCRIPT_URL = os.getenv("COMPANY_SCRIPT_URL")  # URL для получения компании
+BOT_USERNAME = os.getenv("BOT_USERNAME", "Outstaff_connect_bot")  # без @
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # токен для служебных эндпоинтов (без него они выключены)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # secret_token из setWebhook (необязательно)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip('/')  # можно подменить локальной заглушкой
+
+# 🔌 Настройки HTTP-транспорта: пулы keep-alive соединений, ретраи и таймауты
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 0))  # соединений на хост; 0 — по числу потоков, которые ходят в сеть
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.5))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_TIMEOUTS = {  # таймаут чтения по эндпоинтам, секунды
+    endpoint: float(os.getenv(f"HTTP_TIMEOUT_{endpoint.upper()}", default))
+    for endpoint, default in {
+        "send_message": 5,
+        "answer_callback": 5,
+        "get_file": 10,
+        "download": 30,
+        "company": 10,
+        "apps_script": 30,
+        "get_updates": 40,
+        "bot_api": 10,
+    }.items()
+}
+
+# 🧵 Режим приёма update'ов: sync — обработка прямо в запросе, queue — через пул воркеров
+INGEST_MODE = os.getenv("INGEST_MODE", "sync").lower()
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 4))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+
+# 🏢 Кэш chat_id → компания
+COMPANY_CACHE_SIZE = int(os.getenv("COMPANY_CACHE_SIZE", 5000))
+COMPANY_CACHE_TTL = float(os.getenv("COMPANY_CACHE_TTL", 3600))
+COMPANY_CACHE_NEGATIVE_TTL = float(os.getenv("COMPANY_CACHE_NEGATIVE_TTL", 300))  # для "компания не найдена"
+COMPANY_PRELOAD = os.getenv("COMPANY_PRELOAD", "0") == "1"  # загрузить всю таблицу одним запросом
+COMPANY_PRELOAD_INTERVAL = float(os.getenv("COMPANY_PRELOAD_INTERVAL", 0))  # 0 — только при старте
+
+# 🗂️ Позиции, шаблоны и вакансии — в конфиге, перечитываются без перезапуска
+POSITIONS_FILE = os.getenv("POSITIONS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "positions.json"))
+POSITIONS_RELOAD_INTERVAL = float(os.getenv("POSITIONS_RELOAD_INTERVAL", 5))
+
+# 📄 Файлы резюме: лимит размера и порог, после которого файл сбрасывается на диск
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 20 * 1024 * 1024))
+FILE_SPOOL_THRESHOLD = int(os.getenv("FILE_SPOOL_THRESHOLD", 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+BASE64_CHUNK_SIZE = 48 * 1024  # кратно 3, чтобы куски base64 склеивались без паддинга
+
+# 📦 Пакетная запись в таблицу: строки копятся SHEET_BATCH_WINDOW секунд или до лимита строк/байт
+SHEET_BATCH_ENABLED = os.getenv("SHEET_BATCH_ENABLED", "0") == "1"
+SHEET_BATCH_WINDOW = float(os.getenv("SHEET_BATCH_WINDOW", 2.0))
+SHEET_BATCH_MAX_ROWS = int(os.getenv("SHEET_BATCH_MAX_ROWS", 20))
+SHEET_BATCH_MAX_BYTES = int(os.getenv("SHEET_BATCH_MAX_BYTES", 40 * 1024 * 1024))
+
+# ♻️ Защита от повторов: update_id за окно UPDATE_DEDUP_TTL и уже принятые резюме (file_unique_id + соискатель)
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", 24 * 3600))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", 100000))
+# Пока update обрабатывается, отметка живёт только столько: если процесс убьют, Telegram доставит его снова
+UPDATE_PROCESSING_TTL = float(os.getenv("UPDATE_PROCESSING_TTL", 300))
+SUBMISSION_DEDUP_TTL = float(os.getenv("SUBMISSION_DEDUP_TTL", 7 * 24 * 3600))
+SUBMISSION_DEDUP_SIZE = int(os.getenv("SUBMISSION_DEDUP_SIZE", 20000))
+
+# 📮 Лимиты исходящих сообщений Telegram
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))  # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))  # в секунду в личный чат
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", 20 / 60))  # в секунду в группу
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", 5))
+TELEGRAM_SENDER_WORKERS = int(os.getenv("TELEGRAM_SENDER_WORKERS", 2))
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+# 📥 Отложенные записи в таблицу на время недоступности Apps Script
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "1") == "1"
+OUTBOX_DIR = os.getenv("OUTBOX_DIR", "outbox")
+OUTBOX_DRAIN_INTERVAL = float(os.getenv("OUTBOX_DRAIN_INTERVAL", 15))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))  # после стольких неудач запись уходит в dead-letter
+OUTBOX_MAX_AGE = float(os.getenv("OUTBOX_MAX_AGE", 24 * 3600))  # или если она пролежала дольше, секунды
+APPS_SCRIPT_FAILURE_THRESHOLD = int(os.getenv("APPS_SCRIPT_FAILURE_THRESHOLD", 3))
+APPS_SCRIPT_RESET_TIMEOUT = float(os.getenv("APPS_SCRIPT_RESET_TIMEOUT", 60))
+
+# 🖼️ Альбомы: сколько секунд ждать остальные части после последней полученной (0 — не объединять)
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", 1.5))
+
+# 📈 Метрики и трассировка медленных update'ов
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", 10))  # секунды; 0 — не трассировать
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# ⚡ Параллельные запросы внутри одного update и общий дедлайн на подготовку заявки (компания и файлы).
+# Запись в Apps Script идёт после него со своим таймаутом: её нельзя оборвать раньше,
+# не рискуя задвоить строку, поэтому заявка целиком занимает до
+# SUBMISSION_DEADLINE + HTTP_CONNECT_TIMEOUT + HTTP_TIMEOUT_APPS_SCRIPT секунд
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", 16))
+SUBMISSION_DEADLINE = float(os.getenv("SUBMISSION_DEADLINE", 45))
+
+# 🗄️ Общее состояние (кэш компаний, дедупликация, лимиты Telegram, альбомы):
+# memory — в памяти процесса, sqlite — в файле STATE_PATH, общем для всех воркеров gunicorn
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_PATH = os.getenv("STATE_PATH", os.path.join("state", "state.sqlite3"))
+
+# 📈 Каталог, через который процессы (воркеры gunicorn) делятся метриками: каждый раз в
+# METRICS_SNAPSHOT_INTERVAL секунд пишет туда свой снимок, а /metrics складывает все. Пусто — только свой процесс
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 5))
+
+# 🛑 Сколько секунд при остановке ждать очередь update'ов, пачки и исходящие сообщения
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 25))
+
+# 🪵 Логи пишет отдельный поток; json — одна запись-объект на строку, text — привычные строки
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))  # при переполнении записи отбрасываются, запрос не ждёт
+LOG_SAMPLE_RATES = {  # какая доля записей уровня попадает в лог; ERROR и выше пишутся всегда
+    logging.DEBUG: float(os.getenv("LOG_SAMPLE_DEBUG", 1)),
+    logging.INFO: float(os.getenv("LOG_SAMPLE_INFO", 1)),
+    logging.WARNING: float(os.getenv("LOG_SAMPLE_WARNING", 1)),
+}
+LOG_MAX_TEXT = int(os.getenv("LOG_MAX_TEXT", 200))  # тексты сообщений и данные соискателя обрезаются до стольких символов
+LOG_REDACT = os.getenv("LOG_REDACT", "0") == "1"  # вместо текста — только длина и хэш
+LOG_TRACEBACK_FRAMES = int(os.getenv("LOG_TRACEBACK_FRAMES", 10))  # последних кадров трейсбека; 0 — все
+
+
+# 🔌 Общая HTTP-сессия с пулами соединений к api.telegram.org и script.google.com
+def create_http_session():
+    """Создаёт сессию с keep-alive пулами на каждый хост и ретраями с backoff"""
+    # POST повторяется только при ошибках соединения (запрос ещё не ушёл),
+    # GET — ещё и при обрыве чтения и 5xx
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    # По соединению на каждый поток, который ходит в сеть: io_pool, воркеры update'ов, отправка
+    # в Telegram, пачки, outbox и предзагрузка компаний. pool_block — лишние потоки (например,
+    # потоки gunicorn в режиме sync) ждут свободное соединение, а не открывают и выбрасывают новое
+    pool_size = HTTP_POOL_SIZE or IO_POOL_SIZE + UPDATE_WORKERS + TELEGRAM_SENDER_WORKERS + 3
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+http = create_http_session()
+
+def http_request(method, url, endpoint, **kwargs):
+    """Выполняет запрос через общую сессию с таймаутом для данного эндпоинта"""
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = (HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUTS[endpoint])
+    return http.request(method, url, **kwargs)
+
+def telegram_api_url(method):
+    return f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/{method}"
+
+def telegram_file_url(file_path):
+    return f"{TELEGRAM_API_BASE}/file/bot{TELEGRAM_TOKEN}/{file_path}"
+
+
+# 📈 Метрики в текстовом формате Prometheus
+class MetricsRegistry:
+    """Счётчики, гауги и гистограммы с метками; всё в памяти процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> число или [counts по бакетам, sum, count]
+
+    def _declare(self, name, kind, help_text, buckets=None):
+        self._metrics[name] = (kind, help_text, buckets)
+        return name
+
+    def counter(self, name, help_text):
+        return self._declare(name, 'counter', help_text)
+
+    def gauge(self, name, help_text):
+        return self._declare(name, 'gauge', help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._declare(name, 'histogram', help_text, buckets)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._metrics[name][2]
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        """Значения в виде, пригодном для JSON: [[имя, [[метка, значение], ...], значение], ...]"""
+        with self._lock:
+            return [
+                [name, [list(label) for label in labels], [list(value[0]), value[1], value[2]] if isinstance(value, list) else value]
+                for (name, labels), value in self._values.items()
+            ]
+
+    def merge(self, snapshots):
+        """Складывает снимки процессов [(жив ли процесс, снимок)]: счётчики и гистограммы суммируются,
+        гауги (in-flight) берутся только у живых процессов"""
+        merged = {}
+        for alive, snapshot in snapshots:
+            for name, labels, value in snapshot:
+                kind = self._metrics.get(name, (None,))[0]
+                if kind is None or (kind == 'gauge' and not alive):
+                    continue
+                key = (name, tuple(tuple(label) for label in labels))
+                if kind != 'histogram':
+                    merged[key] = merged.get(key, 0) + value
+                    continue
+                entry = merged.setdefault(key, [[0] * len(value[0]), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+                entry[1] += value[1]
+                entry[2] += value[2]
+        return merged
+
+    def render(self, extra_gauges=(), values=None):
+        """extra_gauges — тройки (имя, метки, значение), снятые с /stats в момент запроса;
+        values — сложенные снимки процессов (merge), по умолчанию — значения этого процесса"""
+        lines = []
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        values = sorted(values.items(), key=lambda item: item[0])
+        for name, (kind, help_text, buckets) in self._metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in values:
+                if metric != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        gauges = OrderedDict()
+        for name, labels, value in extra_gauges:
+            gauges.setdefault(name, []).append((labels, value))
+        for name, samples in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram("bot_stage_duration_seconds", "Длительность этапов обработки")
+UPDATE_SECONDS = metrics.histogram("bot_update_duration_seconds", "Полное время обработки update")
+UPDATES_TOTAL = metrics.counter("bot_updates_total", "Обработанные update'ы по статусу")
+IN_FLIGHT = metrics.gauge("bot_in_flight", "Сколько операций выполняется прямо сейчас")
+FILE_BYTES = metrics.counter("bot_file_bytes_total", "Байты файлов: скачано из Telegram и отправлено в Apps Script")
+SLOW_UPDATES = metrics.counter("bot_slow_updates_total", "Update'ы дольше SLOW_UPDATE_THRESHOLD")
+SHEET_WRITES = metrics.counter("bot_sheet_writes_total", "Итог записи в таблицу: ok, sheet_error, deferred")
+
+# Этапы текущего update — собираются для трассировки медленных запросов
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+# ⏱️ Замер этапа: гистограмма, in-flight и запись в трассу текущего update
+@contextmanager
+def stage_timer(stage):
+    metrics.inc(IN_FLIGHT, stage=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.inc(IN_FLIGHT, -1, stage=stage)
+        metrics.observe(STAGE_SECONDS, elapsed, stage=stage)
+        record_stage(stage, elapsed)
+
+def record_stage(stage, elapsed):
+    """Добавляет этап в трассу текущего update, если она есть"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.append((stage, elapsed))
+
+def timed(stage):
+    """Декоратор: замеряет каждый вызов функции как этап stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# 🐢 Этапы одного update
+class UpdateTrace(list):
+    """Список (этап, секунды). Ответы в Telegram уходят уже после обработки, из потоков планировщика,
+    поэтому отчёт о медленном update ждёт, пока отправятся и они (hold/release)"""
+
+    def __init__(self, description):
+        super().__init__()
+        self.description = description
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._finished = None  # (секунды, статус) после выхода из update_trace
+
+    def hold(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            ready = self._pending == 0 and self._finished is not None
+        if ready:
+            self._report()
+
+    def finish(self, elapsed, status):
+        with self._lock:
+            self._finished = (elapsed, status)
+            ready = self._pending == 0
+        if ready:
+            self._report()
+
+    def _report(self):
+        elapsed, status = self._finished
+        if SLOW_UPDATE_THRESHOLD and elapsed >= SLOW_UPDATE_THRESHOLD:
+            metrics.inc(SLOW_UPDATES)
+            stages = list(self)
+            breakdown = ", ".join(f"{stage}={duration:.3f}s" for stage, duration in stages)
+            app.logger.warning("🐢 Медленный %s: %.3fs [%s] %s", self.description, elapsed, status, breakdown,
+                               extra={"stages": stages, "duration": elapsed})
+
+# 🐢 Трассировка update: итоговая гистограмма, счётчик статусов и лог медленных запросов
+@contextmanager
+def update_trace(description):
+    trace = UpdateTrace(description)
+    token = _current_trace.set(trace)
+    metrics.inc(IN_FLIGHT, stage="update")
+    started = time.perf_counter()
+    outcome = {"status": "error"}
+    try:
+        yield outcome
+    finally:
+        elapsed = time.perf_counter() - started
+        _current_trace.reset(token)
+        metrics.inc(IN_FLIGHT, -1, stage="update")
+        metrics.observe(UPDATE_SECONDS, elapsed)
+        metrics.inc(UPDATES_TOTAL, status=outcome["status"])
+        trace.finish(elapsed, outcome["status"])
+
+# ⚡ Запускает функцию в io_pool, сохраняя трассу текущего update
+def submit_io(func, *args):
+    return io_pool.submit(contextvars.copy_context().run, func, *args)
+
+
+# 🪵 Контекст для логов: update_id, chat_id и т.п. текущего update
+_log_context = contextvars.ContextVar("log_context", default={})
+
+@contextmanager
+def log_context(**fields):
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+def bind_log_context(**fields):
+    """Добавляет поля к контексту до выхода из ближайшего log_context"""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+# 🪵 Текст сообщения или данные соискателя в логе
+class LogText:
+    """Обрезается (или скрывается при LOG_REDACT) только когда запись форматируется — в потоке-писателе"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, ensure_ascii=False, default=str)
+        if LOG_REDACT:
+            return f"<{len(text)} симв., sha256:{hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]}>"
+        if len(text) > LOG_MAX_TEXT:
+            text = f"{text[:LOG_MAX_TEXT]}…(+{len(text) - LOG_MAX_TEXT})"
+        return repr(text) if isinstance(self.value, str) else text
+
+
+# 🪵 Сэмплирование: от уровней с большим потоком записей остаётся доля rate
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._lock = threading.Lock()
+        self.sampled_out = 0
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        if rate >= 1 or random.random() < rate:
+            return True
+        with self._lock:
+            self.sampled_out += 1
+        return False
+
+
+def format_traceback(exc_info):
+    limit = -LOG_TRACEBACK_FRAMES if LOG_TRACEBACK_FRAMES > 0 else None
+    return "".join(traceback.format_exception(*exc_info, limit=limit)).rstrip()
+
+
+# 🪵 Одна запись — один JSON-объект
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        entry.update(getattr(record, "context", None) or {})
+        stages = getattr(record, "stages", None)
+        if stages:
+            # Одинаковые этапы (несколько файлов альбома) суммируем
+            totals = {}
+            for stage, duration in stages:
+                totals[stage] = totals.get(stage, 0.0) + duration
+            entry["stages"] = {stage: round(duration, 4) for stage, duration in totals.items()}
+        if getattr(record, "duration", None) is not None:
+            entry["duration"] = round(record.duration, 4)
+        if record.exc_info:
+            entry["exc"] = format_traceback(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# 🪵 Строка как у logging.basicConfig плюс контекст update
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{record.levelname}:{record.name}:{record.getMessage()}"
+        context = getattr(record, "context", None)
+        if context:
+            line += " [" + " ".join(f"{key}={value}" for key, value in context.items()) + "]"
+        if record.exc_info:
+            line += "\n" + format_traceback(record.exc_info)
+        return line
+
+
+# 🪵 Асинхронный вывод логов: поток запроса только кладёт запись в очередь
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """Форматирует и пишет записи QueueListener в отдельном потоке; поток запускается заново после fork"""
+
+    def __init__(self, target, maxsize, sampler):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.sampler = sampler
+        self.addFilter(sampler)
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Записи, оставшиеся в очереди родителя, пишет родитель — у нас своя очередь
+            self.queue = queue.Queue(self.maxsize)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # В отличие от QueueHandler.prepare не собираем здесь msg % args и трейсбек — это сделает поток-писатель
+        record.context = _log_context.get()
+        if getattr(record, "stages", None) is None:
+            trace = _current_trace.get()
+            if trace:
+                record.stages = list(trace)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        self._ensure_started()
+        super().emit(record)
+
+    def close(self):
+        # Вызывается logging.shutdown при выходе: дописываем очередь до конца
+        with self._start_lock:
+            if self._pid == os.getpid() and self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+                self._pid = None
+        super().close()
+
+    def stats(self):
+        return {
+            "format": LOG_FORMAT,
+            "queue_depth": self.queue.qsize(),
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "sampled_out": self.sampler.sampled_out,
+        }
+
+
+def setup_logging():
+    """Заменяет logging.basicConfig: корневой логгер пишет через AsyncLogHandler"""
+    target = logging.StreamHandler()
+    target.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    handler = AsyncLogHandler(target, LOG_QUEUE_SIZE, SamplingFilter(LOG_SAMPLE_RATES))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    return handler
+
+
+log_handler = setup_logging()
+
+
+# 📄 Файл больше MAX_FILE_SIZE
+class FileTooLargeError(Exception):
+    pass
+
+
+# 📄 Содержимое файла: в памяти, а после FILE_SPOOL_THRESHOLD — во временном файле
+class FileBlob:
+    """Файл, который отдаётся в base64 по частям, не создавая полных копий в памяти"""
+
+    def __init__(self, fileobj, size):
+        self.file = fileobj
+        self.size = size
+
+    @property
+    def base64_length(self):
+        return 4 * ((self.size + 2) // 3)
+
+    def iter_base64(self):
+        self.file.seek(0)
+        encoding = 0.0
+        while True:
+            chunk = self.file.read(BASE64_CHUNK_SIZE)
+            if not chunk:
+                break
+            started = time.perf_counter()
+            encoded = base64.b64encode(chunk)
+            encoding += time.perf_counter() - started
+            yield encoded
+        # Кодирование идёт вперемешку с отправкой, поэтому считаем только время самого b64encode
+        metrics.observe(STAGE_SECONDS, encoding, stage="base64_encode")
+        record_stage("base64_encode", encoding)
+
+    def close(self):
+        self.file.close()
+
+
+# 📤 JSON-тело запроса, в котором FileBlob кодируются в base64 на лету
+class StreamingJsonBody:
+    """Итерируемое тело с известной длиной: requests отправит его с Content-Length, без chunked"""
+
+    def __init__(self, payload):
+        token = uuid.uuid4().hex
+        blobs = []
+
+        def substitute(obj):
+            if isinstance(obj, FileBlob):
+                blobs.append(obj)
+                return f"{token}:{len(blobs) - 1}"
+            if isinstance(obj, dict):
+                return {k: substitute(v) for k, v in obj.items()}
+            if isinstance(obj, (list, tuple)):
+                return [substitute(v) for v in obj]
+            return obj
+
+        text = json.dumps(substitute(payload), ensure_ascii=False)
+        pieces = re.split(f'"{token}:(\\d+)"', text)
+        # Чётные элементы — JSON-текст, нечётные — номера файлов
+        self._parts = [
+            piece.encode('utf-8') if i % 2 == 0 else blobs[int(piece)]
+            for i, piece in enumerate(pieces)
+        ]
+        self.length = sum(
+            len(part) if isinstance(part, bytes) else part.base64_length + 2
+            for part in self._parts
+        )
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        # Каждый проход начинается заново — так работают и ретраи urllib3
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield b'"'
+                yield from part.iter_base64()
+                yield b'"'
+
+
+# 📦 Копит записи в таблицу и отправляет их одним запросом
+class SheetBatcher:
+    """Собирает payload'ы за окно SHEET_BATCH_WINDOW и отправляет их в Apps Script пачкой {"action": "batch", "rows": [...]}"""
+
+    def __init__(self, window, max_rows, max_bytes):
+        self.window = window
+        self.max_rows = max(1, max_rows)
+        self.max_bytes = max_bytes
+        self._pending = []  # (payload, size, callback, enqueued_at)
+        self._pending_bytes = 0
+        self._sending = 0
+        self._flushing = False
+        self._cond = threading.Condition()
+        self._pid = None
+        self.batches = 0
+        self.rows = 0
+        self.bytes = 0
+        self.max_batch_rows = 0
+        self.failed_batches = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.flush_reasons = {"window": 0, "rows": 0, "bytes": 0, "shutdown": 0}
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="sheet-batcher", daemon=True).start()
+
+    def submit(self, payload, callback):
+        """Ставит строку в пачку; callback(error) вызывается после отправки (error — SheetWriteError или None)"""
+        self._ensure_started()
+        size = len(StreamingJsonBody(payload))
+        with self._cond:
+            self._pending.append((payload, size, callback, time.monotonic()))
+            self._pending_bytes += size
+            self._cond.notify_all()
+
+    def _flush_reason(self):
+        if self._flushing:
+            return "shutdown"
+        if len(self._pending) >= self.max_rows:
+            return "rows"
+        if self._pending_bytes >= self.max_bytes:
+            return "bytes"
+        if time.monotonic() - self._pending[0][3] >= self.window:
+            return "window"
+        return None
+
+    def _take_batch(self):
+        batch, batch_bytes = [], 0
+        while self._pending and len(batch) < self.max_rows:
+            size = self._pending[0][1]
+            if batch and batch_bytes + size > self.max_bytes:
+                break
+            batch.append(self._pending.pop(0))
+            batch_bytes += size
+        self._pending_bytes -= batch_bytes
+        return batch, batch_bytes
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                reason = self._flush_reason()
+                while reason is None:
+                    self._cond.wait(max(0.0, self._pending[0][3] + self.window - time.monotonic()))
+                    reason = self._flush_reason()
+                batch, batch_bytes = self._take_batch()
+                self.flush_reasons[reason] += 1
+                self._sending += 1
+            try:
+                self._send(batch, batch_bytes)
+            finally:
+                with self._cond:
+                    self._sending -= 1
+                    self._cond.notify_all()
+
+    def flush(self, timeout):
+        """Отправляет всё накопленное, не дожидаясь окна; False — если не успели за timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._flushing = True
+            self._cond.notify_all()
+            while self._pending or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _send(self, batch, batch_bytes):
+        errors = send_batch_to_apps_script([payload for payload, _, _, _ in batch])
+        now = time.monotonic()
+        with self._cond:
+            self.batches += 1
+            self.rows += len(batch)
+            self.bytes += batch_bytes
+            self.max_batch_rows = max(self.max_batch_rows, len(batch))
+            if any(errors):
+                self.failed_batches += 1
+            for _, _, _, enqueued_at in batch:
+                self.latency_total += now - enqueued_at
+                self.latency_max = max(self.latency_max, now - enqueued_at)
+        for (_, _, callback, _), error in zip(batch, errors):
+            try:
+                callback(error)
+            except Exception:
+                app.logger.exception("💥 Ошибка в обработчике результата пачки")
+
+    def stats(self):
+        with self._cond:
+            return {
+                "enabled": SHEET_BATCH_ENABLED,
+                "pending_rows": len(self._pending),
+                "pending_bytes": self._pending_bytes,
+                "batches": self.batches,
+                "failed_batches": self.failed_batches,
+                "rows": self.rows,
+                "bytes": self.bytes,
+                "avg_batch_rows": round(self.rows / self.batches, 2) if self.batches else 0.0,
+                "max_batch_rows": self.max_batch_rows,
+                "avg_latency_seconds": round(self.latency_total / self.rows, 4) if self.rows else 0.0,
+                "max_latency_seconds": round(self.latency_max, 4),
+                "flush_reasons": dict(self.flush_reasons),
+            }
+
+
+# ❌ Неудачная запись в таблицу; retryable — сбой на стороне Apps Script, запись можно повторить позже
+class SheetWriteError:
+    def __init__(self, message, retryable):
+        self.message = message
+        self.retryable = retryable
+
+
+# 🔌 Circuit breaker: после серии сбоев перестаёт обращаться к Apps Script на reset_timeout секунд
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout, on_close=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_close = on_close  # вызывается, когда сервис снова доступен
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Можно ли сейчас обращаться к сервису; в half_open пропускает один пробный запрос"""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and now - self.opened_at < self.reset_timeout:
+                return False
+            if self.state == 'half_open' and now - self.probe_at < self.reset_timeout:
+                return False
+            # Пробный запрос; если его результат так и не пришёл, через reset_timeout пустим ещё один
+            self.state = 'half_open'
+            self.probe_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            recovered = self.state != 'closed'
+            if recovered:
+                app.logger.info("🔌 Apps Script снова доступен — circuit breaker закрыт")
+            self.state = 'closed'
+            self.failures = 0
+        if recovered and self.on_close is not None:
+            self.on_close()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                if self.state == 'closed':
+                    app.logger.error("🔌 Apps Script недоступен — circuit breaker открыт на %s с", self.reset_timeout)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.opens += 1
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "opens": self.opens}
+
+
+# 📥 Очередь отложенных записей в таблицу: SQLite + файлы резюме на диске
+class SheetOutbox:
+    """Хранит payload'ы, которые не удалось записать, и отдаёт их по порядку для повторной отправки.
+    Неудачная запись откладывается с растущей паузой и не задерживает следующие; после max_attempts
+    попыток или max_age секунд она переходит в dead-letter и ждёт ручного replay или drop"""
+
+    COLUMNS = "id, created_at, chat_id, payload, submission_key, attempts, last_error, claimed_until, next_attempt_at, dead_at"
+
+    def __init__(self, directory, max_attempts, max_age, retry_delay):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.db_path = os.path.join(directory, "outbox.sqlite3")
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    os.makedirs(self.blob_dir, exist_ok=True)
+                    with closing(sqlite3.connect(self.db_path, timeout=30)) as conn, conn:
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute(
+                            "CREATE TABLE IF NOT EXISTS outbox ("
+                            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                            " created_at REAL NOT NULL,"
+                            " chat_id TEXT NOT NULL,"
+                            " payload TEXT NOT NULL,"
+                            " submission_key TEXT,"
+                            " attempts INTEGER NOT NULL DEFAULT 0,"
+                            " last_error TEXT,"
+                            " claimed_until REAL,"
+                            " next_attempt_at REAL,"
+                            " dead_at REAL)"
+                        )
+                        # Базы, созданные до появления dead-letter
+                        columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+                        for column in ("next_attempt_at", "dead_at"):
+                            if column not in columns:
+                                conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} REAL")
+                    self._initialized = True
+        return closing(sqlite3.connect(self.db_path, timeout=30))
+
+    def put(self, chat_id, payload, submission_key, error):
+        """Сохраняет payload; файлы копируются в blob_dir до вставки строки"""
+        blob_names = []
+
+        def externalize(obj):
+            if isinstance(obj, FileBlob):
+                name = f"{uuid.uuid4().hex}.bin"
+                with open(os.path.join(self.blob_dir, name), 'wb') as f:
+                    obj.file.seek(0)
+                    shutil.copyfileobj(obj.file, f)
+                blob_names.append(name)
+                return {"$blob": name}
+            if isinstance(obj, dict):
+                return {k: externalize(v) for k, v in obj.items()}
+            if isinstance(obj, (list, tuple)):
+                return [externalize(v) for v in obj]
+            return obj
+
+        with self._connect() as conn:
+            try:
+                stored = json.dumps(externalize(payload), ensure_ascii=False)
+                with conn:
+                    cursor = conn.execute(
+                        "INSERT INTO outbox (created_at, chat_id, payload, submission_key, attempts, last_error)"
+                        " VALUES (?, ?, ?, ?, 1, ?)",
+                        (time.time(), str(chat_id), stored, submission_key, error),
+                    )
+                return cursor.lastrowid
+            except Exception:
+                self._remove_blobs(blob_names)
+                raise
+
+    def claim_next(self, lease=300, due_only=True):
+        """Берёт самую старую запись не из dead-letter, которую не обрабатывает другой процесс.
+        due_only=False — не ждать паузы после неудачи (ручной replay)"""
+        now = time.time()
+        with self._connect() as conn, conn:
+            row = conn.execute(
+                f"SELECT {self.COLUMNS} FROM outbox"
+                " WHERE dead_at IS NULL AND (claimed_until IS NULL OR claimed_until < ?)"
+                " AND (? OR next_attempt_at IS NULL OR next_attempt_at <= ?)"
+                " ORDER BY id LIMIT 1",
+                (now, not due_only, now),
+            ).fetchone()
+            if row is None:
+                return None
+            return self._entry(row) if self._lease(conn, row[0], lease, now) else None
+
+    def claim(self, entry_id, lease=300):
+        """Берёт конкретную запись (в том числе из dead-letter); None — если её нет или её уже отправляют"""
+        now = time.time()
+        with self._connect() as conn, conn:
+            row = conn.execute(f"SELECT {self.COLUMNS} FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+            if row is None or not self._lease(conn, entry_id, lease, now):
+                return None
+            return self._entry(row)
+
+    @staticmethod
+    def _lease(conn, entry_id, lease, now):
+        return conn.execute(
+            "UPDATE outbox SET claimed_until = ? WHERE id = ? AND (claimed_until IS NULL OR claimed_until < ?)",
+            (now + lease, entry_id, now),
+        ).rowcount
+
+    def get(self, entry_id):
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {self.COLUMNS} FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+            return self._entry(row) if row else None
+
+    def list(self, limit=100):
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {self.COLUMNS} FROM outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+            return [self._entry(row) for row in rows]
+
+    def pending_count(self):
+        """Записи, которые ещё будут отправлены автоматически (без dead-letter)"""
+        return self._count("dead_at IS NULL")
+
+    def dead_count(self):
+        return self._count("dead_at IS NOT NULL")
+
+    def _count(self, condition):
+        if not self._initialized and not os.path.exists(self.db_path):
+            return 0
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM outbox WHERE {condition}").fetchone()[0]
+
+    def load_payload(self, entry):
+        """Восстанавливает payload с FileBlob, открытыми из blob_dir"""
+        def internalize(obj):
+            if isinstance(obj, dict):
+                if set(obj) == {"$blob"}:
+                    path = os.path.join(self.blob_dir, obj["$blob"])
+                    return FileBlob(open(path, 'rb'), os.path.getsize(path))
+                return {k: internalize(v) for k, v in obj.items()}
+            if isinstance(obj, list):
+                return [internalize(v) for v in obj]
+            return obj
+
+        return internalize(json.loads(entry["payload"]))
+
+    def release(self, entry_id, error):
+        """Возвращает запись после неудачной попытки; True — если она перешла в dead-letter"""
+        now = time.time()
+        with self._connect() as conn, conn:
+            row = conn.execute("SELECT attempts, created_at, dead_at FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                return False
+            attempts = row[0] + 1  # первая попытка — исходная отправка, ещё до outbox
+            dead = row[2] is None and (attempts >= self.max_attempts or now - row[1] >= self.max_age)
+            conn.execute(
+                "UPDATE outbox SET attempts = ?, last_error = ?, claimed_until = NULL, next_attempt_at = ?,"
+                " dead_at = CASE WHEN ? THEN ? ELSE dead_at END WHERE id = ?",
+                (attempts, error, now + min(self.retry_delay * 2 ** max(0, attempts - 2), 3600), dead, now, entry_id),
+            )
+            return dead
+
+    def remove(self, entry_id):
+        entry = self.get(entry_id)
+        if entry is None:
+            return False
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+        self._remove_blobs(re.findall(r'"\$blob": "([0-9a-f]+\.bin)"', entry["payload"]))
+        return True
+
+    def _remove_blobs(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.blob_dir, name))
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def _entry(cls, row):
+        return dict(zip(cls.COLUMNS.split(", "), row))
+
+
+# 🖼️ Буфер альбомов: части с одним media_group_id собираются и обрабатываются вместе
+class MediaGroupAggregator:
+    """Копит сообщения альбома в shared_state, пока новые части приходят чаще, чем раз в window секунд.
+    Части могут попасть в разные воркеры: альбом забирает тот, чей таймер сработает первым после тишины"""
+
+    NAMESPACE = "media_group"
+    MAX_GROUPS = 10000
+
+    def __init__(self, window, handler, store=None, on_handled=None):
+        self.window = window
+        self.handler = handler
+        self.on_handled = on_handled  # вызывается с update_id частей, когда альбом обработан
+        self.store = shared_state if store is None else store
+        self._timers = {}  # ключ альбома -> Timer этого процесса
+        self._update_ids = {}  # ключ альбома -> update_id частей, принятых этим процессом и ещё не обработанных
+        self._active = 0  # альбомов, которые обрабатываются прямо сейчас
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.groups = 0
+        self.parts = 0
+
+    def add(self, message, update_id=None):
+        key = f"{message.get('chat', {}).get('id')}:{message['media_group_id']}"
+        now = time.time()
+
+        def append(group):
+            if group is _MISSING:
+                group = {"messages": [], "update_ids": []}
+            group["messages"].append(message)
+            if update_id is not None:
+                group.setdefault("update_ids", []).append(update_id)
+            group["last_part_at"] = now
+            return group
+
+        if update_id is not None:
+            with self._lock:
+                self._update_ids.setdefault(key, set()).add(update_id)
+        # Запись живёт дольше окна — на случай, если процесс с таймером упадёт, не дождавшись его
+        self.store.update(self.NAMESPACE, key, append, self.window + 60, self.MAX_GROUPS)
+        self._schedule(key, self.window)
+
+    def pending_update_ids(self):
+        """update_id частей, которые этот процесс принял, но альбом которых ещё не обработан"""
+        with self._lock:
+            return set().union(*self._update_ids.values())
+
+    def _schedule(self, key, delay):
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is not None:
+                timer.cancel()
+            timer = self._timers[key] = threading.Timer(delay, self._flush, (key,))
+            timer.daemon = True
+            timer.start()
+
+    def _flush(self, key):
+        with self._lock:
+            # Отменённый таймер мог успеть запуститься — работает только последний
+            if self._timers.get(key) is not threading.current_thread():
+                return
+            del self._timers[key]
+            self._active += 1
+        try:
+            group = self.store.pop(self.NAMESPACE, key, when=lambda g: time.time() - g["last_part_at"] >= self.window)
+            if group is _MISSING:
+                pending = self.store.get(self.NAMESPACE, key)
+                if pending is not _MISSING:
+                    # Следующая часть пришла в другой процесс — ждём тишины дальше
+                    self._schedule(key, max(0.0, pending["last_part_at"] + self.window - time.time()))
+                else:
+                    # Альбом забрал другой процесс
+                    self._forget(key)
+                return
+            self._handle(key, group)
+        finally:
+            self._finish()
+
+    def _forget(self, key):
+        with self._lock:
+            self._update_ids.pop(key, None)
+
+    def _finish(self):
+        with self._lock:
+            self._active -= 1
+            self._idle.notify_all()
+
+    def flush_all(self):
+        """Сразу обрабатывает альбомы, которые ждут таймеров этого процесса (при остановке)"""
+        with self._lock:
+            timers, self._timers = self._timers, {}
+            self._active += 1
+        try:
+            for key, timer in timers.items():
+                timer.cancel()
+                group = self.store.pop(self.NAMESPACE, key)
+                if group is not _MISSING:
+                    self._handle(key, group)
+                else:
+                    self._forget(key)
+        finally:
+            self._finish()
+
+    def wait_idle(self, timeout=None):
+        """Ждёт, пока этот процесс обработает все собранные альбомы; False — если не дождались за timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._timers or self._active:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+    def _handle(self, key, group):
+        with self._lock:
+            self.groups += 1
+            self.parts += len(group["messages"])
+        messages = sorted(group["messages"], key=lambda m: m.get('message_id', 0))
+        try:
+            self.handler(messages)
+        except Exception:
+            app.logger.exception("💥 Ошибка обработки альбома")
+        finally:
+            self._forget(key)
+            if self.on_handled is not None and group.get("update_ids"):
+                self.on_handled(group["update_ids"])
+
+    def stats(self):
+        with self._lock:
+            return {"buffered": len(self._timers), "groups": self.groups, "parts": self.parts}
+
+
+_MISSING = object()
+
+
+# 🗂️ Скомпилированный реестр позиций: таблицы диспетчеризации и готовые клавиатуры
+class CompiledPositions:
+    """Всё, что нужно для ответа на команды и кнопки, посчитано заранее — обработка сводится к поиску в dict"""
+
+    def __init__(self, config):
+        positions = {p['id']: p for p in config['positions']}
+
+        # callback_data → текст ответа
+        self.callbacks = {}
+        for position_id, position in positions.items():
+            template = position.get('template') or (
+                f"Позиция: {position['position']}\n"
+                f"Команда: {position['team']}\n"
+                "Соискатель: \n"
+                "\n!Прикрепите резюме, напиши ФИО соискателя и поставь @ перед именем бота ниже!"
+                f"\n{BOT_USERNAME}"
+            )
+            self.callbacks[f"template_{position_id}"] = template
+            if position.get('vacancy_url'):
+                self.callbacks[f"vacancy_{position_id}"] = f"📄 Требования по вакансии: {position['vacancy_url']}"
+
+        # команда → (подсказка, сериализованная клавиатура, статус)
+        self.commands = {
+            f"/template@{BOT_USERNAME}": (
+                "Выберите шаблон:",
+                self._keyboard(positions, config.get('template_order'), "template_"),
+                "inline_template_sent",
+            ),
+            f"/vacancy@{BOT_USERNAME}": (
+                "выберете вакансию, по которой хотите посмотреть требования",
+                self._keyboard(positions, config.get('vacancy_order'), "vacancy_"),
+                "inline_vacancy_sent",
+            ),
+        }
+
+    @staticmethod
+    def _keyboard(positions, order, prefix):
+        inline_keyboard = [
+            [{"text": positions[position_id].get('label', position_id), "callback_data": f"{prefix}{position_id}"}]
+            for position_id in (order or positions)
+            if position_id in positions
+        ]
+        return json.dumps({"inline_keyboard": inline_keyboard}, ensure_ascii=False)
+
+    def callback_reply(self, data):
+        reply = self.callbacks.get(data)
+        if reply is not None:
+            return reply
+        if data.startswith("vacancy_"):
+            return "📄 Требования по вакансии: Ссылка не найдена."
+        return "Шаблон не найден."
+
+
+# 🗂️ Реестр позиций из POSITIONS_FILE с перечитыванием при изменении файла
+class PositionRegistry:
+    def __init__(self, path, reload_interval):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._compiled = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self.reloads = 0
+        self.reload_errors = 0
+
+    def current(self):
+        """Возвращает скомпилированный реестр; раз в reload_interval проверяет mtime файла"""
+        now = time.monotonic()
+        if self._compiled is not None and now - self._checked_at < self.reload_interval:
+            return self._compiled
+        with self._lock:
+            if self._compiled is None or now - self._checked_at >= self.reload_interval:
+                self._checked_at = now
+                self._reload_if_changed()
+            return self._compiled
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime and self._compiled is not None:
+                return
+            with open(self.path, encoding='utf-8') as f:
+                compiled = CompiledPositions(json.load(f))
+        except Exception as e:
+            # Битый конфиг не должен ронять бота — продолжаем со старым реестром
+            self.reload_errors += 1
+            app.logger.error("❌ Не удалось загрузить %s: %s", self.path, e)
+            if self._compiled is None:
+                self._compiled = CompiledPositions({"positions": []})
+            return
+        self._compiled = compiled
+        self._mtime = mtime
+        self.reloads += 1
+        app.logger.info("🗂️ Реестр позиций загружен: %d кнопок", len(compiled.callbacks))
+
+    def stats(self):
+        return {"path": self.path, "reloads": self.reloads, "reload_errors": self.reload_errors}
+
+
+# 🪣 Token bucket: rate токенов в секунду, не больше capacity в запасе
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available_at(self, now):
+        """Момент, когда в ведре будет целый токен"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+# 📮 Одно исходящее сообщение
+class OutboundMessage:
+    def __init__(self, method, payload, mergeable=False):
+        self.method = method
+        self.payload = payload
+        self.mergeable = mergeable
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        # Контекст update, который отправил сообщение: логи и этап reply_send попадают в его трассу
+        self.context = contextvars.copy_context()
+        self.trace = _current_trace.get()
+        if self.trace is not None:
+            self.trace.hold()
+
+    def done(self):
+        """Сообщение отправлено или отброшено — трасса update его больше не ждёт"""
+        if self.trace is not None:
+            self.context.run(self.trace.release)
+
+
+# 📮 Планировщик исходящих запросов к Telegram с учётом лимитов
+class OutboundScheduler:
+    """Очереди по чатам, token bucket на бота и на каждый чат, retry_after для 429 и повторы с backoff"""
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self._queues = OrderedDict()  # ключ чата -> deque сообщений
+        self._not_before = {}  # ключ чата -> время, раньше которого слать нельзя (429/backoff)
+        self._busy = set()  # чаты, сообщение в которые отправляется прямо сейчас
+        self._cond = threading.Condition()
+        self._pid = None
+        self.enqueued = 0
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"telegram-sender-{i}", daemon=True).start()
+
+    def send(self, chat_id, method, payload, mergeable=False):
+        """Ставит запрос в очередь; chat_id=None — запрос вне лимитов чатов (answerCallbackQuery)"""
+        self._ensure_started()
+        with self._cond:
+            self._queues.setdefault(chat_id, deque()).append(OutboundMessage(method, payload, mergeable))
+            self.enqueued += 1
+            self._cond.notify()
+
+    def drain(self, timeout):
+        """Ждёт, пока все сообщения будут отправлены; False — если не успели за timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while any(self._queues.values()) or self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    @staticmethod
+    def _limits(chat_id):
+        """Вёдра, из которых берётся токен на сообщение в чат; лежат в shared_state — общие для всех воркеров"""
+        # Отрицательные chat_id — группы, у них лимит строже
+        rate = TELEGRAM_GROUP_RATE if str(chat_id).startswith('-') else TELEGRAM_CHAT_RATE
+        return [
+            (f"telegram:chat:{chat_id}", rate, 1),
+            ("telegram:global", TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE),
+        ]
+
+    def _next_ready(self):
+        """Выбирает чат, в который можно отправить прямо сейчас (без учёта токенов); иначе — время ближайшей готовности"""
+        now = time.monotonic()
+        wake_at = None
+        for chat_id, pending in self._queues.items():
+            if not pending or chat_id in self._busy:
+                continue
+            ready_at = self._not_before.get(chat_id, 0)
+            if ready_at <= now:
+                return chat_id, None
+            wake_at = ready_at if wake_at is None else min(wake_at, ready_at)
+        return _MISSING, wake_at
+
+    def _pop(self, chat_id):
+        pending = self._queues[chat_id]
+        message = pending.popleft()
+        # Подряд идущие простые тексты в один чат склеиваем в одно сообщение
+        while message.mergeable and pending and pending[0].mergeable:
+            text = message.payload['text'] + "\n\n" + pending[0].payload['text']
+            if len(text) > TELEGRAM_MAX_MESSAGE_LENGTH:
+                break
+            pending.popleft().done()
+            message.payload = dict(message.payload, text=text)
+            self.merged += 1
+        # Чат в конец очереди обхода — чтобы не обделять остальные
+        self._queues.move_to_end(chat_id)
+        return message
+
+    def _run(self):
+        while True:
+            with self._cond:
+                chat_id, wake_at = self._next_ready()
+                while chat_id is _MISSING:
+                    self._cond.wait(None if wake_at is None else max(0.0, wake_at - time.monotonic()))
+                    chat_id, wake_at = self._next_ready()
+                # Чат наш, пока берём токены: другие потоки его пропустят
+                self._busy.add(chat_id)
+            # Токены — вне блокировки: в SQLite это транзакция, и send() не должен её ждать
+            wait = shared_state.take_tokens(self._limits(chat_id)) if chat_id is not None else 0.0
+            with self._cond:
+                if wait > 0:
+                    self._busy.discard(chat_id)
+                    self._not_before[chat_id] = time.monotonic() + wait
+                    self._cond.notify_all()
+                    continue
+                message = self._pop(chat_id)
+            retry_in = message.context.run(self._deliver, chat_id, message)
+            if retry_in is None:
+                message.done()
+            with self._cond:
+                self._busy.discard(chat_id)
+                if retry_in is not None:
+                    self._not_before[chat_id] = time.monotonic() + retry_in
+                    self._queues[chat_id].appendleft(message)
+                elif not self._queues[chat_id]:
+                    del self._queues[chat_id]
+                    self._not_before.pop(chat_id, None)
+                self._cond.notify_all()
+
+    def _deliver(self, chat_id, message):
+        """Отправляет сообщение; возвращает паузу перед повтором или None, если повторять не нужно"""
+        message.attempts += 1
+        endpoint = 'answer_callback' if message.method == 'answerCallbackQuery' else 'send_message'
+        try:
+            with stage_timer("reply_send"):
+                response = http_request('POST', telegram_api_url(message.method), endpoint, json=message.payload)
+            status = response.status_code
+        except Exception as e:
+            app.logger.warning("⚠️ Ошибка отправки %s в %s: %s", message.method, chat_id, e)
+            status = None
+
+        if status == 200:
+            delay = time.monotonic() - message.enqueued_at
+            with self._cond:
+                self.sent += 1
+                self.delay_total += delay
+                self.delay_max = max(self.delay_max, delay)
+            return None
+
+        if message.attempts > TELEGRAM_SEND_RETRIES or (status is not None and 400 <= status < 500 and status != 429):
+            with self._cond:
+                self.dropped += 1
+            app.logger.error("❌ Сообщение в %s не отправлено (%s, HTTP %s, попыток: %d)", chat_id, message.method, status, message.attempts)
+            return None
+
+        with self._cond:
+            self.retries += 1
+            if status == 429:
+                self.rate_limited += 1
+        if status == 429:
+            try:
+                return float(response.json().get('parameters', {}).get('retry_after', 1))
+            except Exception:
+                return 1.0
+        return min(HTTP_BACKOFF * (2 ** message.attempts), 30.0)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": sum(len(q) for q in self._queues.values()),
+                "chats_pending": sum(1 for q in self._queues.values() if q),
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "merged": self.merged,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "dropped": self.dropped,
+                "avg_queue_delay_seconds": round(self.delay_total / self.sent, 4) if self.sent else 0.0,
+                "max_queue_delay_seconds": round(self.delay_max, 4),
+            }
+
+# 🗄️ Общее состояние в памяти процесса — для одного процесса (python app.py, main.py)
+class MemoryStateStore:
+    """Пространства имён с TTL и LRU-вытеснением, атомарные операции и token bucket'ы под одной блокировкой"""
+
+    def __init__(self):
+        self._spaces = {}  # namespace -> OrderedDict(key -> (expires_at, value))
+        self._buckets = {}  # key -> TokenBucket
+        self._evictions = {}
+        self._lock = threading.Lock()
+
+    def _live(self, namespace, key, now):
+        space = self._spaces.setdefault(namespace, OrderedDict())
+        entry = space.get(key)
+        if entry is not None and entry[0] <= now:
+            del space[key]
+            return space, None
+        return space, entry
+
+    def _put(self, space, namespace, key, value, ttl, maxsize):
+        space[key] = (time.monotonic() + ttl, value)
+        space.move_to_end(key)
+        while len(space) > maxsize:
+            space.popitem(last=False)
+            self._evictions[namespace] = self._evictions.get(namespace, 0) + 1
+
+    def get(self, namespace, key):
+        """Возвращает значение или _MISSING, если записи нет или она устарела"""
+        with self._lock:
+            space, entry = self._live(namespace, key, time.monotonic())
+            if entry is None:
+                return _MISSING
+            space.move_to_end(key)
+            return entry[1]
+
+    def set(self, namespace, key, value, ttl, maxsize):
+        with self._lock:
+            space, _ = self._live(namespace, key, time.monotonic())
+            self._put(space, namespace, key, value, ttl, maxsize)
+
+    def add(self, namespace, key, value, ttl, maxsize):
+        """Атомарно добавляет запись, если её ещё нет; False — если запись уже есть"""
+        with self._lock:
+            space, entry = self._live(namespace, key, time.monotonic())
+            if entry is not None:
+                return False
+            self._put(space, namespace, key, value, ttl, maxsize)
+            return True
+
+    def update(self, namespace, key, func, ttl, maxsize):
+        """Атомарно заменяет значение на func(старое значение или _MISSING) и возвращает новое"""
+        with self._lock:
+            space, entry = self._live(namespace, key, time.monotonic())
+            value = func(_MISSING if entry is None else entry[1])
+            self._put(space, namespace, key, value, ttl, maxsize)
+            return value
+
+    def pop(self, namespace, key, when=None):
+        """Атомарно удаляет и возвращает значение; если задан when — только когда when(значение) истинно"""
+        with self._lock:
+            space, entry = self._live(namespace, key, time.monotonic())
+            if entry is None or (when is not None and not when(entry[1])):
+                return _MISSING
+            del space[key]
+            return entry[1]
+
+    def delete(self, namespace, key=None):
+        with self._lock:
+            if key is None:
+                self._spaces.pop(namespace, None)
+            else:
+                self._spaces.get(namespace, {}).pop(key, None)
+
+    def take_tokens(self, limits):
+        """Берёт по токену из каждого ведра limits [(ключ, rate, capacity)] — все сразу или ни одного.
+        Возвращает 0, если токены взяты, иначе — сколько секунд подождать"""
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for key, rate, capacity in limits:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(rate, capacity)
+                buckets.append(bucket)
+            ready_at = max((bucket.available_at(now) for bucket in buckets), default=now)
+            if ready_at > now:
+                return ready_at - now
+            for bucket in buckets:
+                bucket.take(now)
+            return 0.0
+
+    def space_stats(self, namespace):
+        with self._lock:
+            return {"size": len(self._spaces.get(namespace, ())), "evictions": self._evictions.get(namespace, 0)}
+
+
+# 🗄️ Общее состояние в SQLite — одно на все воркеры gunicorn одной машины.
+# WAL не работает на сетевых файловых системах (NFS, SMB), поэтому между машинами файл делить нельзя
+class SqliteStateStore:
+    """Тот же интерфейс, что у MemoryStateStore; атомарность — через транзакции BEGIN IMMEDIATE.
+    Вытеснение не LRU: удаляются записи с ближайшим сроком жизни (при одинаковом ttl — самые давно записанные,
+    чтение их не продлевает). Лимит размера проверяется раз в PRUNE_EVERY записей, так что между чистками
+    пространство может быть больше maxsize"""
+
+    PRUNE_EVERY = 256
+    BUCKET_IDLE_TTL = 3600  # ведро, которым не пользовались час, давно полное — его можно удалить
+
+    def __init__(self, path):
+        self.path = path
+        self._initialized = False
+        self._lock = threading.Lock()
+        self._writes = {}  # namespace -> записей с последней чистки (в этом процессе)
+        self._evictions = {}
+        self._local = threading.local()  # соединение на поток; после fork открывается заново
+
+    def _connect(self):
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute(
+                            "CREATE TABLE IF NOT EXISTS state ("
+                            " namespace TEXT NOT NULL,"
+                            " key TEXT NOT NULL,"
+                            " value TEXT NOT NULL,"
+                            " expires_at REAL NOT NULL,"
+                            " PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+                        )
+                        conn.execute("CREATE INDEX IF NOT EXISTS state_expiry ON state (namespace, expires_at)")
+                        conn.execute(
+                            "CREATE TABLE IF NOT EXISTS buckets ("
+                            " key TEXT PRIMARY KEY,"
+                            " tokens REAL NOT NULL,"
+                            " updated_at REAL NOT NULL) WITHOUT ROWID"
+                        )
+                    self._initialized = True
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Транзакция с блокировкой на запись с самого начала — чтение и запись внутри атомарны между процессами"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _read(conn, namespace, key, now):
+        row = conn.execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, str(key), now),
+        ).fetchone()
+        return _MISSING if row is None else json.loads(row[0])
+
+    def _put(self, conn, namespace, key, value, ttl, maxsize, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, str(key), json.dumps(value, ensure_ascii=False), now + ttl),
+        )
+        with self._lock:
+            writes = self._writes[namespace] = self._writes.get(namespace, 0) + 1
+            if writes < self.PRUNE_EVERY:
+                return
+            self._writes[namespace] = 0
+        conn.execute("DELETE FROM state WHERE namespace = ? AND expires_at <= ?", (namespace, now))
+        excess = conn.execute("SELECT COUNT(*) FROM state WHERE namespace = ?", (namespace,)).fetchone()[0] - maxsize
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM state WHERE namespace = ? AND key IN"
+                " (SELECT key FROM state WHERE namespace = ? ORDER BY expires_at LIMIT ?)",
+                (namespace, namespace, excess),
+            )
+            with self._lock:
+                self._evictions[namespace] = self._evictions.get(namespace, 0) + excess
+
+    def get(self, namespace, key):
+        return self._read(self._connect(), namespace, key, time.time())
+
+    def set(self, namespace, key, value, ttl, maxsize):
+        with self._transaction() as conn:
+            self._put(conn, namespace, key, value, ttl, maxsize, time.time())
+
+    def add(self, namespace, key, value, ttl, maxsize):
+        now = time.time()
+        with self._transaction() as conn:
+            if self._read(conn, namespace, key, now) is not _MISSING:
+                return False
+            self._put(conn, namespace, key, value, ttl, maxsize, now)
+            return True
+
+    def update(self, namespace, key, func, ttl, maxsize):
+        now = time.time()
+        with self._transaction() as conn:
+            value = func(self._read(conn, namespace, key, now))
+            self._put(conn, namespace, key, value, ttl, maxsize, now)
+            return value
+
+    def pop(self, namespace, key, when=None):
+        with self._transaction() as conn:
+            value = self._read(conn, namespace, key, time.time())
+            if value is _MISSING or (when is not None and not when(value)):
+                return _MISSING
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, str(key)))
+            return value
+
+    def delete(self, namespace, key=None):
+        with self._transaction() as conn:
+            if key is None:
+                conn.execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+            else:
+                conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+    def take_tokens(self, limits):
+        now = time.time()
+        with self._transaction() as conn:
+            tokens, wait = [], 0.0
+            for key, rate, capacity in limits:
+                row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+                available = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                if available < 1:
+                    wait = max(wait, (1 - available) / rate)
+                tokens.append((key, available))
+            if wait > 0:
+                return wait
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                [(key, available - 1, now) for key, available in tokens],
+            )
+            with self._lock:
+                writes = self._writes["buckets"] = self._writes.get("buckets", 0) + 1
+                if writes >= self.PRUNE_EVERY:
+                    self._writes["buckets"] = 0
+                    conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - self.BUCKET_IDLE_TTL,))
+            return 0.0
+
+    def space_stats(self, namespace):
+        size = self._connect().execute(
+            "SELECT COUNT(*) FROM state WHERE namespace = ? AND expires_at > ?", (namespace, time.time())
+        ).fetchone()[0]
+        with self._lock:
+            return {"size": size, "evictions": self._evictions.get(namespace, 0)}
+
+
+def create_state_store():
+    if STATE_BACKEND == "sqlite":
+        return SqliteStateStore(STATE_PATH)
+    if STATE_BACKEND != "memory":
+        raise ValueError(f"Неизвестный STATE_BACKEND: {STATE_BACKEND} (ожидается memory или sqlite)")
+    return MemoryStateStore()
+
+
+shared_state = create_state_store()
+
+
+# 🗃️ Кэш с TTL поверх общего состояния
+class TTLCache:
+    """Ограниченный по размеру кэш в своём пространстве имён shared_state: записи живут ttl секунд, лишние вытесняются"""
+
+    def __init__(self, namespace, maxsize, ttl, store=None):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = shared_state if store is None else store
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Возвращает значение или _MISSING, если записи нет или она устарела"""
+        value = self.store.get(self.namespace, key)
+        self._count(value is not _MISSING)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.store.set(self.namespace, key, value, self.ttl if ttl is None else ttl, self.maxsize)
+
+    def add(self, key, value=True, ttl=None):
+        """Атомарно (в том числе между процессами) добавляет запись, если её ещё нет; False — если запись уже есть"""
+        added = self.store.add(self.namespace, key, value, self.ttl if ttl is None else ttl, self.maxsize)
+        self._count(not added)
+        return added
+
+    def invalidate(self, key=None):
+        """Удаляет одну запись или, если key не указан, весь кэш"""
+        self.store.delete(self.namespace, key)
+
+    def stats(self):
+        space = self.store.space_stats(self.namespace)
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": space["size"],
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": space["evictions"],
+            }
+
+
+company_cache = TTLCache("company", COMPANY_CACHE_SIZE, COMPANY_CACHE_TTL)
+seen_updates = TTLCache("update", UPDATE_DEDUP_SIZE, UPDATE_DEDUP_TTL)
+accepted_submissions = TTLCache("submission", SUBMISSION_DEDUP_SIZE, SUBMISSION_DEDUP_TTL)
+sheet_batcher = SheetBatcher(SHEET_BATCH_WINDOW, SHEET_BATCH_MAX_ROWS, SHEET_BATCH_MAX_BYTES)
+telegram_outbox = OutboundScheduler(TELEGRAM_SENDER_WORKERS)
+positions = PositionRegistry(POSITIONS_FILE, POSITIONS_RELOAD_INTERVAL)
+outbox_wakeup = threading.Event()  # будит фоновую отправку outbox, когда Apps Script снова доступен
+apps_script_breaker = CircuitBreaker(APPS_SCRIPT_FAILURE_THRESHOLD, APPS_SCRIPT_RESET_TIMEOUT, on_close=outbox_wakeup.set)
+sheet_outbox = SheetOutbox(OUTBOX_DIR, OUTBOX_MAX_ATTEMPTS, OUTBOX_MAX_AGE, OUTBOX_DRAIN_INTERVAL)
+outbox_stats = {"deferred": 0, "replayed": 0, "replay_failures": 0, "dead_lettered": 0}
+io_pool = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix="io")
+company_preload_stats = {"runs": 0, "failures": 0, "loaded": 0, "last_run": None}
+
+
+# 🧵 Пул фоновых воркеров для обработки update'ов
+class UpdateWorkerPool:
+    """Очередь update'ов и пул потоков, которые прогоняют их через handle_update"""
+
+    def __init__(self, handler, workers, maxsize):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._started_at = time.monotonic()
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _ensure_started(self):
+        # Потоки запускаются лениво и заново после fork — в дочернем процессе их нет
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._started_at = time.monotonic()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"update-worker-{i}", daemon=True).start()
+
+    def submit(self, update):
+        """Ставит update в очередь; False — если очередь переполнена"""
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((time.monotonic(), update))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def _run(self):
+        while True:
+            enqueued_at, update = self.queue.get()
+            started = time.monotonic()
+            with self._lock:
+                self.busy += 1
+                self.wait_seconds += started - enqueued_at
+            failed = False
+            try:
+                _, code = self.handler(update)
+                failed = code >= 500
+            except Exception:
+                failed = True
+                app.logger.exception("💥 Ошибка в воркере")
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.busy_seconds += time.monotonic() - started
+                    self.processed += 1
+                    if failed:
+                        self.failed += 1
+                self.queue.task_done()
+
+    def drain(self, timeout):
+        """Ждёт, пока очередь опустеет и все update'ы будут обработаны; False — если не успели за timeout"""
+        deadline = time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+            return True
+
+    def stats(self):
+        with self._lock:
+            uptime = max(time.monotonic() - self._started_at, 1e-9)
+            return {
+                "mode": INGEST_MODE,
+                "workers": self.workers,
+                "busy": self.busy,
+                "utilisation": round(self.busy / self.workers, 3),
+                "utilisation_avg": round(self.busy_seconds / (uptime * self.workers), 3),
+                "queue_depth": self.queue.qsize(),
+                "queue_capacity": self.queue.maxsize,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_wait_seconds": round(self.wait_seconds / self.processed, 4) if self.processed else 0.0,
+            }
 
 # ➡️ Обработчик для проверки здоровья сервиса
 @app.route('/', methods=['GET'])
 def health_check():
     return "OK", 200
 
+# 📊 Состояние очереди, воркеров и кэшей
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(collect_stats()), 200
+
+# 📈 Метрики для Prometheus: гистограммы этапов, счётчики статусов и всё числовое из /stats.
+# С METRICS_DIR — сумма по всем процессам, а гауги из /stats — у каждого живого воркера с меткой worker
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if METRICS_DIR:
+        write_metrics_snapshot()
+        snapshots = load_metrics_snapshots()
+        body = metrics.render(
+            [(name, (("worker", snapshot["pid"]),), value)
+             for alive, snapshot in snapshots if alive for name, value in snapshot["stats"]],
+            metrics.merge([(alive, snapshot["values"]) for alive, snapshot in snapshots]),
+        )
+    else:
+        body = metrics.render([(name, (), value) for name, value in flatten_stats("bot", collect_stats())])
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+_metrics_snapshot_file = (None, None)  # (pid, имя файла) — у каждого процесса свой файл
+_metrics_snapshot_lock = threading.Lock()
+
+def write_metrics_snapshot():
+    """Записывает метрики и /stats этого процесса в METRICS_DIR (атомарно, через временный файл)"""
+    global _metrics_snapshot_file
+    # Пишут и фоновый поток, и /metrics: без блокировки процесс мог завести два файла и посчитаться дважды
+    with _metrics_snapshot_lock:
+        if _metrics_snapshot_file[0] != os.getpid():
+            # pid может достаться новому воркеру — случайный суффикс не даёт затереть счётчики умершего
+            _metrics_snapshot_file = (os.getpid(), f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, _metrics_snapshot_file[1])
+        snapshot = {"pid": os.getpid(), "values": metrics.snapshot(), "stats": list(flatten_stats("bot", collect_stats()))}
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(f"{path}.tmp", path)
+
+def load_metrics_snapshots():
+    """Снимки всех процессов: [(жив ли процесс, снимок)]. Снимки завершившихся воркеров остаются —
+    без них счётчики уменьшались бы после перезапуска воркера"""
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                snapshots.append((os.path.getmtime(path), json.load(f)))
+        except (OSError, ValueError):
+            continue  # файл удалили или дописывают прямо сейчас
+    newest = {}  # pid живого процесса -> время его последнего снимка
+    for mtime, snapshot in snapshots:
+        if _process_alive(snapshot["pid"]):
+            newest[snapshot["pid"]] = max(newest.get(snapshot["pid"], 0), mtime)
+    return [(newest.get(snapshot["pid"]) == mtime, snapshot) for mtime, snapshot in snapshots]
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # процесс есть, но чужой
+
+def run_metrics_snapshots():
+    # Первый снимок — сразу после старта, чтобы /metrics другого воркера видел этот процесс
+    while True:
+        try:
+            write_metrics_snapshot()
+        except Exception:
+            app.logger.exception("💥 Не удалось записать снимок метрик")
+        time.sleep(METRICS_SNAPSHOT_INTERVAL)
+
+def collect_stats():
+    return {
+        "updates": update_pool.stats(),
+        "company_cache": dict(company_cache.stats(), preload=company_preload_stats),
+        "sheet_batches": sheet_batcher.stats(),
+        "telegram_outbound": telegram_outbox.stats(),
+        "positions": positions.stats(),
+        "media_groups": media_groups.stats(),
+        "outbox": dict(outbox_stats, enabled=OUTBOX_ENABLED, pending=sheet_outbox.pending_count() if OUTBOX_ENABLED else 0,
+                       dead=sheet_outbox.dead_count() if OUTBOX_ENABLED else 0, circuit=apps_script_breaker.stats()),
+        "dedup": {"updates": seen_updates.stats(), "submissions": accepted_submissions.stats()},
+        "process": {"pid": os.getpid(), "state_backend": STATE_BACKEND, "shutting_down": shutting_down.is_set()},
+        "logging": log_handler.stats(),
+    }
+
+def flatten_stats(prefix, value):
+    """Разворачивает вложенный dict в пары (имя_метрики, число); строки и None пропускаются"""
+    if isinstance(value, dict):
+        for key, nested in value.items():
+            yield from flatten_stats(f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', str(key))}", nested)
+    elif isinstance(value, bool):
+        yield prefix, int(value)
+    elif isinstance(value, (int, float)):
+        yield prefix, value
+
+# 🧹 Сброс кэша компаний (весь или для одного chatId)
+@app.route('/admin/company-cache/invalidate', methods=['POST'])
+def company_cache_invalidate():
+    if not ADMIN_TOKEN or request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({"status": "forbidden"}), 403
+    chat_id = (request.get_json(silent=True) or {}).get('chatId')
+    invalidate_company_cache(chat_id)
+    return jsonify({"status": "invalidated", "chatId": chat_id}), 200
+
+# 🔁 Запуск фоновых задач (лениво и заново в каждом процессе после fork)
+_background_pid = None
+_background_lock = threading.Lock()
+
+@app.before_request
+def start_background_services():
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+        if COMPANY_PRELOAD and COMPANY_SCRIPT_URL:
+            threading.Thread(target=run_company_preloader, name="company-preloader", daemon=True).start()
+        if OUTBOX_ENABLED:
+            threading.Thread(target=run_outbox_drainer, name="outbox-drainer", daemon=True).start()
+        if METRICS_DIR:
+            threading.Thread(target=run_metrics_snapshots, name="metrics-snapshots", daemon=True).start()
+
 # ➡️ Глобальный обработчик ошибок
 @app.errorhandler(Exception)
 def handle_exception(e):
-    app.logger.error(f"💥 Необработанная ошибка:\n{traceback.format_exc()}")
+    app.logger.error("💥 Необработанная ошибка", exc_info=e)
     return jsonify({"status": "error", "message": str(e)}), 500
 
-# ➡️ Обработчик вебхука от Telegram
-@app.route('/webhook', methods=['POST'])
-def telegram_webhook():
+# ♻️ Отсеивает повторно доставленные update'ы и передаёт остальные в process_update
+def handle_update(update):
+    update_id = update.get('update_id')
+    with log_context(update_id=update_id):
+        if update_id is not None and not seen_updates.add(update_id, "processing", ttl=UPDATE_PROCESSING_TTL):
+            app.logger.info("♻️ Повтор update_id %s — пропускаем", update_id)
+            metrics.inc(UPDATES_TOTAL, status="duplicate")
+            return {"status": "duplicate"}, 200
+
+        try:
+            with update_trace(f"update {update_id}") as outcome:
+                result, code = process_update(update)
+                outcome["status"] = result.get("status", "unknown")
+        except BaseException:
+            if update_id is not None:
+                seen_updates.invalidate(update_id)
+            raise
+        if update_id is not None:
+            if code >= 500:
+                # Telegram доставит update снова — дадим ему обработаться
+                seen_updates.invalidate(update_id)
+            elif result.get("status") != "media_group_buffered":
+                # Обработан — теперь помним его всё окно UPDATE_DEDUP_TTL.
+                # Часть альбома пока только в буфере: её отметку продлит mark_updates_handled
+                seen_updates.set(update_id, True)
+        return result, code
+
+# 🧠 Обрабатывает один update от Telegram, возвращает (ответ, HTTP-код)
+def process_update(update):
     try:
-        update = request.get_json()
-        
         # 🆕 Обработка нажатия inline-кнопок
         if 'callback_query' in update:
             callback = update['callback_query']
             chat_id = callback['message']['chat']['id']
+            bind_log_context(chat_id=chat_id)
             data = callback['data']
 
-         # 🆕 Обработка кнопок вакансий
-            if data.startswith("vacancy_"):
-                vacancy_map = {
-                    "vacancy_DEVOPS_GREENPLUM": "https://docs.google.com/document/d/1XC3no-zSn1yHJ5H5XKjSyXQ4qlhCYMJ2b2d_s16zwOk/edit?tab=t.0",
-                    "vacancy_DEV_GREENPLUM": "https://docs.google.com/document/d/1v3MH3On2-nqsN2OHBeYyE1JEe4qcOK2CoFgL7c1gnGM/edit?tab=t.0",
-                    "vacancy_DEVOPS INFRASTRUCTURE": "https://docs.google.com/document/d/1AbuouxaQLJsn9IpMMrbBuj0Dps6aUJD4gYm9pOduZA4/edit?usp=sharing",
-                    "vacancy_DEVOPS DATASERVICES": "https://docs.google.com/document/d/1M9uywodvTiDiBqJt1BPDHlLAdJev9hvG1lEII5VatVk/edit?usp=sharing"
-                }
-                url = vacancy_map.get(data, "Ссылка не найдена.")
-                send_telegram_message(chat_id, f"📄 Требования по вакансии: {url}")
-            else:
-                template = "Вакансия не найдена!"
-
-            # Отправляем шаблон в ответ на нажатие кнопки
-            if data == "template_DEVOPS_GREENPLUM":
-                template = (
-                    "Позиция: DEVOPS GREENPLUM\n"
-                    "Команда: ARENADATADB\n"
-                    "Соискатель: \n"
-                    "\n!Прикрепите резюме, напиши ФИО соискателя и поставь @ перед именем бота ниже!"
-                    "\nOutstaff_connect_bot"
-                )
-            elif data == "template_DEV_GREENPLUM":
-                template = (
-                    "Позиция: DEV GREENPLUM\n"
-                    "Команда: ARENADATADB\n"
-                    "Соискатель: \n"
-                    "\n!Прикрепите резюме, напиши ФИО соискателя и поставь @ перед именем бота ниже!"
-                    "\nOutstaff_connect_bot"
-                )
-            elif data == "template_DEVOPS INFRASTRUCTURE":
-                template = (
-                    "Позиция: SENIOR DEVOPS CORE\n"
-                    "Команда: DATAMASTERS\n"
-                    "Соискатель: \n"
-                    "\n!Прикрепите резюме, напиши ФИО соискателя и поставь @ перед именем бота ниже!"
-                    "\nOutstaff_connect_bot"
-                )
-            elif data == "template_DEVOPS DATASERVICES":
-                template = (
-                    "Позиция: SENIOR DEVOPS DS\n"
-                    "Команда: DATASERVICES\n"
-                    "Соискатель: \n"
-                    "\n!Прикрепите резюме, напиши ФИО соискателя и поставь @ перед именем бота ниже!"
-                    "\nOutstaff_connect_bot"
-                )
-            else:
-                template = "Шаблон не найден."
-
-            # Отправляем шаблон пользователю
-            send_telegram_message(chat_id, template)
+            # 🆕 Шаблон или ссылку на вакансию берём из реестра позиций
+            send_telegram_message(chat_id, positions.current().callback_reply(data))
 
             # Отвечаем на callback, чтобы убрать "часики" у пользователя
-            callback_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery"
-            requests.post(callback_url, json={"callback_query_id": callback['id']})
+            answer_callback_query(callback['id'])
 
-            return jsonify({"status": "callback_handled"}), 200
+            return {"status": "callback_handled"}, 200
 
         # Проверяем, есть ли сообщение
         if 'message' not in update:
             app.logger.warning("⚠️ Нет ключа 'message' в update")
-            return jsonify({"status": "no_message"}), 200
+            return {"status": "no_message"}, 200
 
         message = update['message']
+
+        # 🖼️ Части альбома копим по media_group_id и обрабатываем одной заявкой
+        if message.get('media_group_id') and MEDIA_GROUP_WINDOW > 0:
+            media_groups.add(message, update.get('update_id'))
+            return {"status": "media_group_buffered"}, 200
+
+        return process_message(message)
+
+    except Exception as e:
+        app.logger.error("💥 Ошибка в process_update: %s", e)
+        return {"status": "error", "message": str(e)}, 500
+
+
+# 💬 Обрабатывает сообщение; album — все части альбома, если сообщение пришло в составе media group
+def process_message(message, album=None):
+    try:
         chat = message.get('chat', {})
         chat_id = chat.get('id')
+        bind_log_context(chat_id=chat_id)
         if not chat_id:
             app.logger.warning("⚠️ Нет chat_id")
-            return jsonify({"status": "no_chat_id"}), 200
+            return {"status": "no_chat_id"}, 200
 
         # 📝 Получаем текст
         text = ""
@@ -114,40 +2113,25 @@ def telegram_webhook():
             text = message['text']
         elif 'caption' in message:
             text = message['caption']
-            app.logger.info(f"📎 Использую caption: {text}")
+            app.logger.info("📎 Использую caption: %s", LogText(text))
         else:
             app.logger.warning("⚠️ Ни text, ни caption не найдены")
-            return jsonify({"status": "no_text"}), 200
+            return {"status": "no_text"}, 200
 
-        app.logger.info(f"📩 Получен текст: {repr(text)}")
+        app.logger.info("📩 Получен текст: %s", LogText(text))
 
         # 🆕 Обработка команды /start
         if text.startswith('/start'):
-            help_text = "👋 Привет! Я помогу тебе быстро отправить резюме.\n\nНажми /template@Outstaff_connect_bot, чтобы выбрать шаблон."
+            help_text = f"👋 Привет! Я помогу тебе быстро отправить резюме.\n\nНажми /template@{BOT_USERNAME}, чтобы выбрать шаблон."
             send_telegram_message(chat_id, help_text)
-            return jsonify({"status": "start_sent"}), 200
-
-        # 🆕 Обработка команды /template@Outstaff_connect_bot
-        if text == "/template@Outstaff_connect_bot":
-            inline_keyboard = [
-                [{"text": "DEVOPS_GREENPLUM", "callback_data": "template_DEVOPS_GREENPLUM"}],
-                [{"text": "DEV_GREENPLUM", "callback_data": "template_DEV_GREENPLUM"}],
-                [{"text": "DEVOPS DATASERVICES", "callback_data": "template_DEVOPS DATASERVICES"}],
-                [{"text": "DEVOPS INFRASTRUCTURE", "callback_data": "template_DEVOPS INFRASTRUCTURE"}]
-            ]
-            send_telegram_inline_keyboard(chat_id, "Выберите шаблон:", inline_keyboard)
-            return jsonify({"status": "inline_template_sent"}), 200
-
-        # 🆕 Обработка команды /vacancy@Outstaff_connect_bot
-        if text == "/vacancy@Outstaff_connect_bot":
-            inline_keyboard = [
-                [{"text": "DEVOPS_GREENPLUM", "callback_data": "vacancy_DEVOPS_GREENPLUM"}],
-                [{"text": "DEV_GREENPLUM", "callback_data": "vacancy_DEV_GREENPLUM"}],
-                [{"text": "DEVOPS INFRASTRUCTURE", "callback_data": "vacancy_DEVOPS INFRASTRUCTURE"}],
-                [{"text": "DEVOPS DATASERVICES", "callback_data": "vacancy_DEVOPS DATASERVICES"}]
-            ]
-            send_telegram_inline_keyboard(chat_id, "выберете вакансию, по которой хотите посмотреть требования", inline_keyboard)
-            return jsonify({"status": "inline_vacancy_sent"}), 200
+            return {"status": "start_sent"}, 200
+
+        # 🆕 Обработка команд /template и /vacancy — клавиатуры собраны заранее
+        command = positions.current().commands.get(text)
+        if command:
+            prompt, reply_markup, status = command
+            send_telegram_reply_markup(chat_id, prompt, reply_markup)
+            return {"status": status}, 200
 
         # 🆕 Проверяем, нужно ли боту реагировать
         should_respond = False
@@ -158,7 +2142,7 @@ def telegram_webhook():
             app.logger.info("👤 Личный чат — обрабатываем сообщение")
 
         elif chat_type in ['group', 'supergroup']:
-            bot_username = "@Outstaff_connect_bot"
+            bot_username = f"@{BOT_USERNAME}"
             entities = message.get('entities', []) + message.get('caption_entities', [])
 
             for entity in entities:
@@ -168,156 +2152,488 @@ def telegram_webhook():
                         if mention.lower() == bot_username.lower():
                             should_respond = True
                             text = text.replace(mention, "").strip()
-                            app.logger.info(f"📢 Бот упомянут в группе — обрабатываем: {text}")
+                            app.logger.info("📢 Бот упомянут в группе — обрабатываем: %s", LogText(text))
                             break
                     except Exception as e:
-                        app.logger.warning(f"⚠️ Ошибка при извлечении mention: {e}")
+                        app.logger.warning("⚠️ Ошибка при извлечении mention: %s", e)
                         continue
 
         if not should_respond:
             app.logger.info("🔕 Бот не упомянут — игнорируем сообщение")
-            return jsonify({"status": "ignored"}), 200
+            return {"status": "ignored"}, 200
 
         # 🔍 Парсим текст
-        parsed_data = parse_message(text) if text else {}
+        with stage_timer("parse_message"):
+            parsed_data = parse_message(text) if text else {}
         if not parsed_data:
             send_telegram_message(chat_id, "⚠️ Не удалось распознать данные. Отправьте в формате:\nПозиция: ...\nКоманда: ...\nСоискатель: ...\nКомпания: ...")
-            return jsonify({"status": "parse_failed"}), 200
+            return {"status": "parse_failed"}, 200
 
-        # 🆕 Получаем название компании из базы по chat_id
-        company_name = get_company_by_chat_id(chat_id)
-        if company_name:
-            parsed_data['Компания'] = company_name
-            app.logger.info(f"🏢 Компания определена по chat_id {chat_id}: {company_name}")
-        else:
-            app.logger.info(f"ℹ️ Компания не найдена для chat_id {chat_id}, используем из сообщения")
+        # 📄 Проверяем наличие файлов в сообщении (или во всех частях альбома)
+        attachments = collect_attachments(album or [message])
 
-        # 📄 Проверяем наличие файла в сообщении
-        has_document = 'document' in message
-        has_photo = 'photo' in message and len(message['photo']) > 0
-        
-        if not has_document and not has_photo:
+        if not attachments:
             error_message = (
                 "❌ Файл не найден в сообщении.\n\n"
                 "Пожалуйста, прикрепите файл резюме к сообщению с данными.\n\n"
             )
             send_telegram_message(chat_id, error_message)
             app.logger.warning("⚠️ Сообщение не содержит файла - остановка обработки")
-            return jsonify({"status": "no_file"}), 200
+            return {"status": "no_file"}, 200
 
-        # 📄 Обработка файла (документа)
-        file_data = None
-        if has_document:
-            try:
-                file_id = message['document']['file_id']
-                original_file_name = message['document'].get('file_name', 'unknown_file')
-                mime_type = message['document'].get('mime_type', 'application/octet-stream')
-                
-                applicant_name = parsed_data.get('Соискатель', 'unknown')
-                position_name = parsed_data.get('Позиция', 'unknown')
-                
-                if '.' in original_file_name:
-                    ext = original_file_name.rsplit('.', 1)[1]
-                else:
-                    ext = 'pdf'
-                
-                new_file_name = f"{applicant_name} - {position_name}.{ext}"
-                
-                file_path = get_telegram_file_path(file_id)
-                if file_path:
-                    file_content = download_file(file_path)
-                    if file_content:
-                        file_base64 = base64.b64encode(file_content).decode('utf-8')
-                        file_data = {
-                            "name": new_file_name,
-                            "base64": file_base64,
-                            "mimeType": mime_type
-                        }
-                        app.logger.info(f"📄 Файл переименован: {new_file_name}")
-            except Exception as e:
-                app.logger.error(f"❌ Ошибка обработки файла: {str(e)}")
-                send_telegram_message(chat_id, "❌ Ошибка обработки файла. Попробуйте отправить снова.")
-                return jsonify({"status": "file_processing_error"}), 200
+        # ♻️ Это резюме этого соискателя уже принято — не скачиваем и не отправляем повторно
+        submission_key = submission_dedup_key([attachment for _, attachment in attachments], parsed_data)
+        if submission_key and accepted_submissions.get(submission_key) is not _MISSING:
+            send_telegram_message(chat_id, "✅ Это резюме уже добавлено в таблицу ранее.")
+            app.logger.info("♻️ Повторная отправка резюме %s — пропускаем", submission_key)
+            return {"status": "duplicate_submission"}, 200
+
+        # ⚡ Компания и файлы не зависят друг от друга — запрашиваем параллельно
+        deadline = time.monotonic() + SUBMISSION_DEADLINE
+        company_future = submit_io(get_company_by_chat_id, chat_id)
+        file_futures = [
+            submit_io(fetch_document if kind == 'document' else fetch_photo, attachment, parsed_data, index)
+            for index, (kind, attachment) in enumerate(attachments)
+        ]
 
-        # 📄 Обработка фото (если отправлено как фото вместо документа)
-        elif has_photo:
+        # 📄 Обработка файлов (документов или фото)
+        files = []
+        for position, ((kind, _), file_future) in enumerate(zip(attachments, file_futures)):
             try:
-                # Берем фото наибольшего размера (последнее в массиве)
-                photo = message['photo'][-1]
-                file_id = photo['file_id']
-                
-                applicant_name = parsed_data.get('Соискатель', 'unknown')
-                position_name = parsed_data.get('Позиция', 'unknown')
-                new_file_name = f"{applicant_name} - {position_name}.jpg"
-                
-                file_path = get_telegram_file_path(file_id)
-                if file_path:
-                    file_content = download_file(file_path)
-                    if file_content:
-                        file_base64 = base64.b64encode(file_content).decode('utf-8')
-                        file_data = {
-                            "name": new_file_name,
-                            "base64": file_base64,
-                            "mimeType": "image/jpeg"
-                        }
-                        app.logger.info(f"📸 Фото обработано: {new_file_name}")
+                file_data = file_future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FileTooLargeError as e:
+                abandon_files(files, file_futures[position:])
+                app.logger.warning("⚠️ Слишком большой файл: %s", e)
+                send_telegram_message(chat_id, file_too_large_message())
+                return {"status": "file_too_large"}, 200
+            except FuturesTimeoutError:
+                abandon_files(files, file_futures[position:])
+                return report_file_error(chat_id, kind == 'document', f"превышен дедлайн {SUBMISSION_DEADLINE} с")
             except Exception as e:
-                app.logger.error(f"❌ Ошибка обработки фото: {str(e)}")
-                send_telegram_message(chat_id, "❌ Ошибка обработки фото. Попробуйте отправить файл как документ.")
-                return jsonify({"status": "photo_processing_error"}), 200
+                abandon_files(files, file_futures[position:])
+                return report_file_error(chat_id, kind == 'document', str(e))
+            if file_data:
+                files.append(file_data)
+
+        # 🆕 Получаем название компании из базы по chat_id
+        try:
+            company_name = company_future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FuturesTimeoutError:
+            app.logger.warning("⚠️ Компания для chat_id %s не получена до дедлайна", chat_id)
+            company_name = None
+        if company_name:
+            parsed_data['Компания'] = company_name
+            app.logger.info("🏢 Компания определена по chat_id %s: %s", chat_id, company_name)
+        else:
+            app.logger.info("ℹ️ Компания не найдена для chat_id %s, используем из сообщения", chat_id)
 
         # 📤 Отправляем в Google Apps Script
-        payload = {
-            "data": parsed_data,
-            "file": file_data,
-            "chatId": chat_id  # Добавляем chatId в payload
-        }
+        return submit_to_sheet(chat_id, parsed_data, files, submission_key)
+
+    except Exception as e:
+        app.logger.error("💥 Ошибка в process_message: %s", e)
+        return {"status": "error", "message": str(e)}, 500
+
+# 🖼️ Собирает альбом в одну заявку: подпись берётся из той части, где она есть
+def process_media_group(messages):
+    primary = next((m for m in messages if m.get('caption') or m.get('text')), messages[0])
+    with log_context(media_group_id=primary.get('media_group_id')):
+        with update_trace(f"album {primary.get('media_group_id')}") as outcome:
+            result, _ = process_message(primary, album=messages)
+            outcome["status"] = result.get("status", "unknown")
+        app.logger.info("🖼️ Альбом %s из %d частей: %s", primary.get('media_group_id'), len(messages), result.get('status'))
+
+
+# ♻️ Части альбома помним всё окно UPDATE_DEDUP_TTL только после того, как альбом обработан
+def mark_updates_handled(update_ids):
+    for update_id in update_ids:
+        seen_updates.set(update_id, True)
+
+
+media_groups = MediaGroupAggregator(MEDIA_GROUP_WINDOW, process_media_group, on_handled=mark_updates_handled)
+update_pool = UpdateWorkerPool(handle_update, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+shutting_down = threading.Event()
+
+# 🛑 Корректная остановка процесса: доделываем принятые update'ы, альбомы, пачки и исходящие сообщения
+def drain_background_work(timeout=SHUTDOWN_TIMEOUT):
+    """Вызывается из хука worker_exit gunicorn; True — если всё успели за timeout"""
+    shutting_down.set()
+    deadline = time.monotonic() + timeout
+
+    def remaining():
+        return max(0.0, deadline - time.monotonic())
+
+    drained = update_pool.drain(remaining())
+    media_groups.flush_all()
+    drained = sheet_batcher.flush(remaining()) and drained
+    drained = telegram_outbox.drain(remaining()) and drained
+    if METRICS_DIR:
+        # Счётчики завершившегося воркера остаются в сумме /metrics
+        try:
+            write_metrics_snapshot()
+        except Exception:
+            app.logger.exception("💥 Не удалось записать снимок метрик")
+    if drained:
+        app.logger.info("🛑 Фоновая работа завершена, процесс можно останавливать")
+    else:
+        app.logger.warning("🛑 Не успели завершить фоновую работу за %s с: %s", timeout, json.dumps(collect_stats(), ensure_ascii=False))
+    return drained
+
+# ➡️ Обработчик вебхука от Telegram
+@app.route('/webhook', methods=['POST'])
+def telegram_webhook():
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        app.logger.warning("⚠️ Неверный secret token вебхука")
+        return jsonify({"status": "forbidden"}), 403
+
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict):
+        app.logger.warning("⚠️ Тело запроса не является JSON-объектом")
+        return jsonify({"status": "bad_request"}), 400
+
+    if INGEST_MODE == 'queue':
+        if shutting_down.is_set():
+            # Очередь этого процесса уже дочищается — Telegram повторит update, и его примет другой воркер
+            return jsonify({"status": "shutting_down"}), 503
+        # Быстро подтверждаем Telegram, обработка уйдёт в фоновые воркеры
+        if not update_pool.submit(update):
+            app.logger.error("💥 Очередь update'ов переполнена")
+            return jsonify({"status": "queue_full"}), 503
+        return jsonify({"status": "queued"}), 200
+
+    result, code = handle_update(update)
+    return jsonify(result), code
+
+
+# 📄 Скачивает документ и готовит его для таблицы
+def fetch_document(document, parsed_data, index=0):
+    """Возвращает file_data для payload или None, если файл не удалось получить; index — номер файла в альбоме"""
+    file_id = document['file_id']
+    original_file_name = document.get('file_name', 'unknown_file')
+    mime_type = document.get('mime_type', 'application/octet-stream')
+    check_file_size(document.get('file_size'))
+
+    applicant_name = parsed_data.get('Соискатель', 'unknown')
+    position_name = parsed_data.get('Позиция', 'unknown')
+
+    if '.' in original_file_name:
+        ext = original_file_name.rsplit('.', 1)[1]
+    else:
+        ext = 'pdf'
+
+    new_file_name = f"{applicant_name} - {position_name}{file_name_suffix(index)}.{ext}"
+
+    file_path = get_telegram_file_path(file_id)
+    if file_path:
+        file_blob = download_file(file_path)
+        if file_blob:
+            app.logger.info("📄 Файл переименован: %s", LogText(new_file_name))
+            return {
+                "name": new_file_name,
+                "base64": file_blob,
+                "mimeType": mime_type
+            }
+    return None
+
+# 📸 Скачивает фото (если отправлено как фото вместо документа)
+def fetch_photo(photo, parsed_data, index=0):
+    file_id = photo['file_id']
+    check_file_size(photo.get('file_size'))
+
+    applicant_name = parsed_data.get('Соискатель', 'unknown')
+    position_name = parsed_data.get('Позиция', 'unknown')
+    new_file_name = f"{applicant_name} - {position_name}{file_name_suffix(index)}.jpg"
+
+    file_path = get_telegram_file_path(file_id)
+    if file_path:
+        file_blob = download_file(file_path)
+        if file_blob:
+            app.logger.info("📸 Фото обработано: %s", LogText(new_file_name))
+            return {
+                "name": new_file_name,
+                "base64": file_blob,
+                "mimeType": "image/jpeg"
+            }
+    return None
+
+# 📎 Второй и следующие файлы альбома получают номер в имени
+def file_name_suffix(index):
+    return f" ({index + 1})" if index else ""
+
+# 📎 Вложения сообщений: документы и фото (фото — в наибольшем размере, последнее в массиве)
+def collect_attachments(messages):
+    attachments = []
+    for message in messages:
+        if 'document' in message:
+            attachments.append(('document', message['document']))
+        elif message.get('photo'):
+            attachments.append(('photo', message['photo'][-1]))
+    return attachments
 
+# ❌ Сообщает об ошибке получения файла
+def report_file_error(chat_id, is_document, error):
+    if is_document:
+        app.logger.error("❌ Ошибка обработки файла: %s", error)
+        send_telegram_message(chat_id, "❌ Ошибка обработки файла. Попробуйте отправить снова.")
+        return {"status": "file_processing_error"}, 200
+    app.logger.error("❌ Ошибка обработки фото: %s", error)
+    send_telegram_message(chat_id, "❌ Ошибка обработки фото. Попробуйте отправить файл как документ.")
+    return {"status": "photo_processing_error"}, 200
+
+# 🗑️ Закрывает уже скачанные файлы и те, что докачаются после отказа от заявки
+def abandon_files(files, futures):
+    for file_data in files:
+        file_data["base64"].close()
+    for future in futures:
+        future.add_done_callback(close_abandoned_file)
+
+def close_abandoned_file(future):
+    if not future.cancelled() and future.exception() is None and future.result():
+        future.result()["base64"].close()
+
+# 📤 Отправляет данные кандидата в таблицу — сразу или через пакетную запись
+def submit_to_sheet(chat_id, parsed_data, files, submission_key=None):
+    """files — список file_data: первый уходит в поле file, остальные (части альбома) — в extraFiles"""
+    file_data = files[0] if files else None
+    payload = {
+        "data": parsed_data,
+        "file": file_data,
+        "chatId": chat_id  # Добавляем chatId в payload
+    }
+    if len(files) > 1:
+        payload["extraFiles"] = files[1:]
+
+    def on_done(error):
+        """Сообщает результат в чат и возвращает статус: ok, deferred (в outbox) или sheet_error"""
         try:
-            response = requests.post(APPS_SCRIPT_URL, json=payload, timeout=30)
-            if response.status_code == 200:
-                send_telegram_message(chat_id, "✅ Данные и файл добавлены в таблицу!")
-                app.logger.info(f"📤 Успешно отправлено: {parsed_data}, файл: {'да' if file_data else 'нет'}")
+            if error is not None and error.retryable and defer_to_outbox(chat_id, payload, submission_key, error.message):
+                status = "deferred"
             else:
-                error_msg = f"❌ Ошибка сервера таблицы: {response.status_code}"
-                send_telegram_message(chat_id, error_msg)
-                app.logger.error(error_msg)
-        except Exception as e:
-            error_msg = "❌ Не удалось отправить данные."
-            send_telegram_message(chat_id, error_msg)
-            app.logger.error(f"❌ Исключение при отправке: {str(e)}")
+                if error is None and submission_key:
+                    accepted_submissions.set(submission_key, {"chatId": chat_id, "at": time.time()})
+                report_sheet_result(chat_id, parsed_data, file_data, error)
+                status = "ok" if error is None else "sheet_error"
+            metrics.inc(SHEET_WRITES, result=status)
+            return status
+        finally:
+            for blob in iter_file_blobs(files):
+                blob.close()
+
+    # Пока circuit breaker разомкнут — пишем сразу в outbox; накопленное отправит фоновый поток
+    if OUTBOX_ENABLED and not apps_script_breaker.allow():
+        return {"status": on_done(SheetWriteError("Apps Script недоступен (circuit breaker)", retryable=True))}, 200
+
+    if SHEET_BATCH_ENABLED:
+        # Итог пачки станет известен позже — он попадёт в bot_sheet_writes_total
+        sheet_batcher.submit(payload, on_done)
+        return {"status": "batched"}, 200
+
+    return {"status": on_done(send_to_apps_script(payload))}, 200
+
+# ♻️ Ключ резюме: те же файлы для одного соискателя на одну позицию
+def submission_dedup_key(attachments, parsed_data):
+    unique_ids = [attachment.get('file_unique_id') for attachment in attachments]
+    if not all(unique_ids):
+        return None
+    file_unique_id = ",".join(sorted(unique_ids))
+    applicant = parsed_data.get('Соискатель', '').strip().lower()
+    position = parsed_data.get('Позиция', '').strip().lower()
+    return f"{file_unique_id}|{applicant}|{position}"
+
+# 📤 Отправляет один payload в Apps Script, возвращает SheetWriteError или None
+def send_to_apps_script(payload):
+    try:
+        response = post_apps_script(payload)
+    except Exception as e:
+        app.logger.error("❌ Исключение при отправке: %s", e)
+        apps_script_breaker.record_failure()
+        return SheetWriteError("❌ Не удалось отправить данные.", retryable=True)
+    return check_apps_script_response(response)
+
+# 📦 Отправляет пачку payload'ов одним запросом, возвращает список ошибок по строкам
+def send_batch_to_apps_script(rows):
+    """Apps Script отвечает {"status": "success", "results": [{"status": "success" | "error", "message": ...}]}"""
+    try:
+        response = post_apps_script({"action": "batch", "rows": rows})
+    except Exception as e:
+        app.logger.error("❌ Исключение при отправке пачки: %s", e)
+        apps_script_breaker.record_failure()
+        return [SheetWriteError("❌ Не удалось отправить данные.", retryable=True)] * len(rows)
+    error = check_apps_script_response(response)
+    if error is not None:
+        return [error] * len(rows)
+    try:
+        result = response.json()
+    except ValueError:
+        # Apps Script ответил 200, но что записано, неизвестно — как и с некорректными results, без повтора
+        app.logger.error("❌ Ответ на пачку из %d строк — не JSON: %s", len(rows), LogText(response.text))
+        return [SheetWriteError("❌ Ошибка сервера таблицы: некорректный ответ на пачку", retryable=False)] * len(rows)
+
+    if not isinstance(result, dict) or result.get('status') != 'success':
+        # Apps Script без поддержки action=batch ничего не записал — отправляем строки по одной
+        message = result.get('message') if isinstance(result, dict) else None
+        app.logger.error("❌ Пачка не принята (%s) — отправляем %d строк по одной", message, len(rows))
+        return [send_to_apps_script(row) for row in rows]
 
-        return jsonify({"status": "ok"}), 200
+    results = result.get('results')
+    if not isinstance(results, list) or len(results) != len(rows) or not all(isinstance(r, dict) for r in results):
+        # Что записано, неизвестно — повтор может задвоить строки, поэтому сообщаем об ошибке без повтора
+        app.logger.error("❌ Некорректный ответ на пачку из %d строк: %s", len(rows), LogText(result))
+        return [SheetWriteError("❌ Ошибка сервера таблицы: некорректный ответ на пачку", retryable=False)] * len(rows)
+    return [
+        None if result.get('status') == 'success'
+        else SheetWriteError(f"❌ Ошибка сервера таблицы: {result.get('message', 'Unknown error')}", retryable=False)
+        for result in results
+    ]
 
+# 🔌 Разбирает HTTP-ответ Apps Script и обновляет circuit breaker
+def check_apps_script_response(response):
+    if response.status_code == 200:
+        apps_script_breaker.record_success()
+        return None
+    # 5xx и 429 — сервис перегружен или недоступен, такую запись имеет смысл повторить
+    retryable = response.status_code >= 500 or response.status_code == 429
+    if retryable:
+        apps_script_breaker.record_failure()
+    return SheetWriteError(f"❌ Ошибка сервера таблицы: {response.status_code}", retryable)
+
+@timed("apps_script_post")
+def post_apps_script(payload):
+    body = StreamingJsonBody(payload)
+    metrics.inc(FILE_BYTES, len(body), direction="upload")
+    return http_request(
+        'POST', APPS_SCRIPT_URL, 'apps_script',
+        data=body,
+        headers={'Content-Type': 'application/json; charset=utf-8'},
+    )
+
+# 📨 Сообщает в чат результат записи в таблицу
+def report_sheet_result(chat_id, parsed_data, file_data, error):
+    if error is None:
+        send_telegram_message(chat_id, "✅ Данные и файл добавлены в таблицу!")
+        app.logger.info("📤 Успешно отправлено: %s, файл: %s", LogText(parsed_data), 'да' if file_data else 'нет')
+    else:
+        send_telegram_message(chat_id, error.message)
+        app.logger.error(error.message)
+
+# 📥 Откладывает запись в outbox; False — если outbox выключен или сохранить не удалось
+def defer_to_outbox(chat_id, payload, submission_key, error):
+    if not OUTBOX_ENABLED:
+        return False
+    try:
+        entry_id = sheet_outbox.put(chat_id, payload, submission_key, error)
     except Exception as e:
-        app.logger.error(f"💥 Ошибка в telegram_webhook: {str(e)}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        app.logger.error("❌ Не удалось сохранить запись в outbox: %s", e)
+        return False
+    outbox_stats["deferred"] += 1
+    send_telegram_message(chat_id, "⏳ Таблица временно недоступна. Данные и файл сохранены и будут добавлены автоматически.")
+    app.logger.warning("📥 Запись #%s отложена в outbox: %s", entry_id, error)
+    return True
+
+# 🔁 Повторно отправляет одну запись из outbox и сообщает результат в чат
+def replay_outbox_entry(entry):
+    """Возвращает None при успехе или SheetWriteError; retryable-ошибки оставляют запись в outbox"""
+    payload = sheet_outbox.load_payload(entry)
+    try:
+        error = send_to_apps_script(payload)
+    finally:
+        for blob in iter_file_blobs(payload):
+            blob.close()
 
+    chat_id = int(entry["chat_id"])
+    if error is not None and error.retryable:
+        outbox_stats["replay_failures"] += 1
+        if sheet_outbox.release(entry["id"], error.message):
+            outbox_stats["dead_lettered"] += 1
+            app.logger.error("☠️ Запись #%s не отправлена за %d попыток — перенесена в dead-letter: %s",
+                             entry["id"], entry["attempts"] + 1, error.message)
+            send_telegram_message(
+                chat_id,
+                f"❌ Не удалось добавить данные в таблицу: {error.message}\n"
+                "Запись передана администратору. Если резюме срочное, отправьте его ещё раз.",
+            )
+        return error
+
+    sheet_outbox.remove(entry["id"])
+    outbox_stats["replayed"] += 1
+    if error is None and entry["submission_key"]:
+        accepted_submissions.set(entry["submission_key"], {"chatId": chat_id, "at": time.time()})
+    report_sheet_result(chat_id, payload.get("data"), payload.get("file"), error)
+    return error
+
+def iter_file_blobs(obj):
+    if isinstance(obj, FileBlob):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from iter_file_blobs(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            yield from iter_file_blobs(value)
+
+# 🔁 Фоновая отправка outbox по порядку, пока Apps Script отвечает
+def run_outbox_drainer():
+    while True:
+        outbox_wakeup.wait(OUTBOX_DRAIN_INTERVAL)
+        outbox_wakeup.clear()
+        try:
+            # Неудачная запись откладывается с паузой, поэтому идём дальше; остановит только circuit breaker
+            while sheet_outbox.pending_count() and apps_script_breaker.allow():
+                entry = sheet_outbox.claim_next()
+                if entry is None:
+                    break
+                replay_outbox_entry(entry)
+        except Exception:
+            app.logger.exception("💥 Ошибка при разборе outbox")
 
 # 🔗 Получает путь к файлу от Telegram API
+@timed("get_file")
 def get_telegram_file_path(file_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getFile?file_id={file_id}"
     try:
-        response = requests.get(url, timeout=10)
+        response = http_request('GET', telegram_api_url('getFile'), 'get_file', params={'file_id': file_id})
         if response.status_code == 200:
             result = response.json()
             if result.get('ok'):
                 return result['result']['file_path']
     except Exception as e:
-        app.logger.error(f"❌ Ошибка получения пути файла: {str(e)}")
+        app.logger.error("❌ Ошибка получения пути файла: %s", e)
     return None
 
-# 📥 Скачивает файл с серверов Telegram
+# 📥 Скачивает файл с серверов Telegram по частям
+@timed("download")
 def download_file(file_path):
-    file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
+    """Возвращает FileBlob; большие файлы уходят во временный файл, лимит проверяется по ходу загрузки"""
+    spool = tempfile.SpooledTemporaryFile(max_size=FILE_SPOOL_THRESHOLD)
     try:
-        response = requests.get(file_url, timeout=30)
-        if response.status_code == 200:
-            return response.content
+        with http_request('GET', telegram_file_url(file_path), 'download', stream=True) as response:
+            if response.status_code != 200:
+                spool.close()
+                return None
+            check_file_size(response.headers.get('Content-Length'))
+
+            size = 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                metrics.inc(FILE_BYTES, len(chunk), direction="download")
+                check_file_size(size)
+                spool.write(chunk)
+            return FileBlob(spool, size)
+    except FileTooLargeError:
+        spool.close()
+        raise
     except Exception as e:
-        app.logger.error(f"❌ Ошибка скачивания файла: {str(e)}")
+        spool.close()
+        app.logger.error("❌ Ошибка скачивания файла: %s", e)
     return None
 
+# 📏 Проверяет размер файла до и во время скачивания
+def check_file_size(size):
+    if size and int(size) > MAX_FILE_SIZE:
+        raise FileTooLargeError(f"{int(size)} байт при лимите {MAX_FILE_SIZE}")
+
+def file_too_large_message():
+    return f"❌ Файл слишком большой. Максимальный размер — {MAX_FILE_SIZE / (1024 * 1024):.3g} МБ."
+
 # 🔍 Парсит текст сообщения вида "Ключ: Значение"
 def parse_message(text):
     try:
@@ -333,69 +2649,176 @@ def parse_message(text):
         if all(key in parsed for key in required):
             return parsed
         else:
-            app.logger.warning(f"❌ Не хватает полей. Распарсено: {parsed}")
+            app.logger.warning("❌ Не хватает полей. Распарсено: %s", LogText(parsed))
             return None
     except Exception as e:
-        app.logger.error(f"❌ Ошибка парсинга: {str(e)}")
+        app.logger.error("❌ Ошибка парсинга: %s", e)
         return None
 
-# 🏢 Получает название компании по chat_id из Google Таблицы
+# 🏢 Получает название компании по chat_id (через кэш)
+@timed("company_lookup")
 def get_company_by_chat_id(chat_id):
-    """Получает название компании из Google Таблицы по chat_id"""
-    try:
-        # Если URL для получения компании не настроен, возвращаем None
-        if not COMPANY_SCRIPT_URL:
-            app.logger.warning("⚠️ COMPANY_SCRIPT_URL не настроен, пропускаем определение компании")
-            return None
-            
-        payload = {
-            "action": "get_company",
-            "chatId": str(chat_id)
-        }
-        
-        response = requests.post(COMPANY_SCRIPT_URL, json=payload, timeout=10)
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('status') == 'success' and result.get('company'):
-                return result.get('company')
-            else:
-                app.logger.warning(f"⚠️ Компания не найдена для chat_id {chat_id}: {result.get('message', 'Unknown error')}")
-        
+    """Получает название компании по chat_id: сначала из кэша, затем из Google Таблицы"""
+    # Если URL для получения компании не настроен, возвращаем None
+    if not COMPANY_SCRIPT_URL:
+        app.logger.warning("⚠️ COMPANY_SCRIPT_URL не настроен, пропускаем определение компании")
         return None
-        
+
+    key = str(chat_id)
+    cached = company_cache.get(key)
+    if cached is not _MISSING:
+        return cached
+
+    try:
+        company = fetch_company_by_chat_id(chat_id)
     except Exception as e:
-        app.logger.error(f"❌ Ошибка получения компании по chat_id {chat_id}: {str(e)}")
+        # Ошибки не кэшируем — при следующем сообщении попробуем снова
+        app.logger.error("❌ Ошибка получения компании по chat_id %s: %s", chat_id, e)
         return None
 
+    if company:
+        company_cache.set(key, company)
+    else:
+        company_cache.set(key, None, ttl=COMPANY_CACHE_NEGATIVE_TTL)
+    return company
+
+# 🏢 Запрашивает компанию по chat_id из Google Таблицы
+def fetch_company_by_chat_id(chat_id):
+    """Возвращает компанию или None, если её нет; при сбое запроса бросает исключение"""
+    payload = {
+        "action": "get_company",
+        "chatId": str(chat_id)
+    }
+
+    response = http_request('POST', COMPANY_SCRIPT_URL, 'company', json=payload)
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+
+    result = response.json()
+    if result.get('status') == 'success' and result.get('company'):
+        return result.get('company')
+
+    app.logger.warning("⚠️ Компания не найдена для chat_id %s: %s", chat_id, result.get('message', 'Unknown error'))
+    return None
+
+# 🏢 Загружает всю таблицу chat_id → компания одним запросом
+def preload_companies():
+    """Заполняет кэш компаний целиком; Apps Script должен поддерживать action=get_all_companies"""
+    response = http_request('POST', COMPANY_SCRIPT_URL, 'company', json={"action": "get_all_companies"})
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+
+    result = response.json()
+    if result.get('status') != 'success':
+        raise RuntimeError(result.get('message', 'Unknown error'))
+
+    companies = result.get('companies') or {}
+    for chat_id, company in companies.items():
+        if company:
+            company_cache.set(str(chat_id), company)
+    return len(companies)
+
+def run_company_preloader():
+    """Загружает компании при старте и, если задан интервал, периодически повторяет"""
+    # С общим состоянием таблицу за период загружает один воркер, остальные читают его записи из кэша
+    lease = COMPANY_PRELOAD_INTERVAL / 2 if COMPANY_PRELOAD_INTERVAL > 0 else COMPANY_CACHE_TTL
+    while True:
+        if shared_state.add("lock", "company_preload", os.getpid(), lease, 100):
+            company_preload_stats["runs"] += 1
+            company_preload_stats["last_run"] = time.time()
+            try:
+                company_preload_stats["loaded"] = preload_companies()
+                app.logger.info("🏢 Загружено компаний в кэш: %d", company_preload_stats['loaded'])
+            except Exception as e:
+                company_preload_stats["failures"] += 1
+                shared_state.delete("lock", "company_preload")
+                app.logger.error("❌ Ошибка предзагрузки компаний: %s", e)
+        if COMPANY_PRELOAD_INTERVAL <= 0:
+            return
+        time.sleep(COMPANY_PRELOAD_INTERVAL)
+
+def invalidate_company_cache(chat_id=None):
+    """Сбрасывает кэш компаний: для одного chat_id или целиком"""
+    company_cache.invalidate(None if chat_id is None else str(chat_id))
+    app.logger.info("🧹 Кэш компаний сброшен: %s", chat_id if chat_id is not None else 'весь')
+
 # 📨 Отправляет сообщение обратно в Telegram
 def send_telegram_message(chat_id, text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {
         'chat_id': chat_id,
         'text': text
     }
-    try:
-        requests.post(url, json=payload, timeout=5)
-    except Exception as e:
-        app.logger.error(f"❌ Не удалось отправить сообщение в Telegram: {str(e)}")
+    telegram_outbox.send(chat_id, 'sendMessage', payload, mergeable=True)
 
-# 📨 Отправляет сообщение с inline-клавиатурой
-def send_telegram_inline_keyboard(chat_id, text, inline_keyboard):
-    """Отправляет сообщение с inline-клавиатурой"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+# 📨 Отправляет сообщение с заранее сериализованной клавиатурой (reply_markup — JSON-строка)
+def send_telegram_reply_markup(chat_id, text, reply_markup):
     payload = {
         'chat_id': chat_id,
         'text': text,
-        'reply_markup': {
-            'inline_keyboard': inline_keyboard
-        }
+        'reply_markup': reply_markup
     }
-    try:
-        requests.post(url, json=payload, timeout=5)
-    except Exception as e:
-        app.logger.error(f"❌ Не удалось отправить inline клавиатуру: {str(e)}")
+    telegram_outbox.send(chat_id, 'sendMessage', payload)
+
+# ⏳ Отвечает на callback, чтобы убрать "часики" у пользователя
+def answer_callback_query(callback_query_id):
+    telegram_outbox.send(None, 'answerCallbackQuery', {"callback_query_id": callback_query_id})
+
+# 🛠️ CLI для outbox: flask --app app outbox list | replay | drop
+@app.cli.group('outbox')
+def outbox_cli():
+    """Просмотр и ручная отправка отложенных записей в таблицу"""
+
+@outbox_cli.command('list')
+@click.option('--limit', default=50, help='Сколько записей показать')
+def outbox_list(limit):
+    for entry in sheet_outbox.list(limit):
+        data = json.loads(entry['payload']).get('data') or {}
+        created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['created_at']))
+        click.echo(
+            f"#{entry['id']} {created}{' ☠️ dead-letter' if entry['dead_at'] else ''} chat={entry['chat_id']} "
+            f"попыток={entry['attempts']} {data.get('Соискатель', '?')} / {data.get('Позиция', '?')} — {entry['last_error']}"
+        )
+    click.echo(f"Всего в outbox: {sheet_outbox.pending_count()}, в dead-letter: {sheet_outbox.dead_count()}")
+
+@outbox_cli.command('replay')
+@click.option('--id', 'entry_id', type=int, default=None, help='Отправить только эту запись')
+def outbox_replay(entry_id):
+    """Отправляет записи по порядку, не глядя на circuit breaker; останавливается на первом сбое.
+    С --id можно отправить и запись из dead-letter"""
+    if entry_id is not None:
+        # Захватываем запись, чтобы её не отправил одновременно фоновый поток сервера
+        entry = sheet_outbox.claim(entry_id)
+        if entry is None:
+            if sheet_outbox.get(entry_id) is None:
+                raise click.ClickException(f"Запись #{entry_id} не найдена")
+            raise click.ClickException(f"Запись #{entry_id} сейчас отправляется, попробуйте позже")
+        entries = iter([entry])
+    else:
+        # Паузу после прошлых неудач не ждём: replay запускают, когда Apps Script уже снова доступен
+        entries = iter(lambda: sheet_outbox.claim_next(due_only=False), None)
+
+    replayed = 0
+    for entry in entries:
+        replayed += 1
+        error = replay_outbox_entry(entry)
+        click.echo(f"#{entry['id']}: {'отправлено' if error is None else error.message}")
+        if error is not None and error.retryable:
+            break
+    if not replayed:
+        click.echo(f"Нечего отправлять. Сейчас отправляет сервер: {sheet_outbox.pending_count()}, "
+                   f"в dead-letter: {sheet_outbox.dead_count()} (их — через --id)")
+    telegram_outbox.drain(60)
+
+@outbox_cli.command('drop')
+@click.argument('entry_id', type=int)
+def outbox_drop(entry_id):
+    """Удаляет запись и её файлы без отправки"""
+    if not sheet_outbox.remove(entry_id):
+        raise click.ClickException(f"Запись #{entry_id} не найдена")
+    click.echo(f"#{entry_id} удалена")
 
 # 🚀 Запуск сервера
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    start_background_services()
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1 @@
+# 🏋️ Офлайн-бенчмарк: локальные заглушки Telegram и Apps Script + нагрузка на /webhook
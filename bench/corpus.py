@@ -0,0 +1,98 @@
+# 📦 Синтетический корпус update'ов для нагрузки на /webhook
+import random
+
+BOT_USERNAME = "Outstaff_connect_bot"
+
+# Доли типов update'ов в корпусе
+DEFAULT_MIX = {
+    "command": 0.10,
+    "callback": 0.10,
+    "document_small": 0.30,
+    "document_medium": 0.15,
+    "document_large": 0.05,
+    "photo": 0.10,
+    "group_mention": 0.10,
+    "group_ignored": 0.05,
+    "parse_failed": 0.05,
+}
+
+FILE_SIZES = {
+    "document_small": 50 * 1024,
+    "document_medium": 1024 * 1024,
+    "document_large": 8 * 1024 * 1024,
+    "photo": 300 * 1024,
+    "group_mention": 200 * 1024,
+}
+
+
+def _caption(rng, index):
+    return (
+        f"Позиция: DEVOPS GREENPLUM\n"
+        f"Команда: ARENADATADB\n"
+        f"Соискатель: Кандидат {index} {rng.randint(1000, 9999)}"
+    )
+
+
+def _document(index, size):
+    # file_id кодирует размер — заглушка getFile вернёт файл такого размера
+    return {
+        "file_id": f"bench{index}-{size}",
+        "file_unique_id": f"u{index}",
+        "file_name": f"resume{index}.pdf",
+        "mime_type": "application/pdf",
+        "file_size": size,
+    }
+
+
+def make_update(kind, index, rng):
+    # chat_id 1..50 — компания найдётся, 51..100 — нет (проверяем негативный кэш)
+    chat_id = rng.randint(1, 100)
+    private = {"id": chat_id, "type": "private"}
+    group = {"id": -1000 - chat_id, "type": "supergroup"}
+    message = {"message_id": index, "date": 0}
+
+    if kind == "command":
+        message.update(chat=private, text=rng.choice(["/start", f"/template@{BOT_USERNAME}", f"/vacancy@{BOT_USERNAME}"]))
+    elif kind == "callback":
+        return {
+            "update_id": index,
+            "callback_query": {
+                "id": f"cb{index}",
+                "data": rng.choice(["template_DEVOPS_GREENPLUM", "template_DEV_GREENPLUM", "vacancy_DEVOPS DATASERVICES"]),
+                "message": {"message_id": index, "chat": private},
+            },
+        }
+    elif kind.startswith("document"):
+        message.update(chat=private, caption=_caption(rng, index), document=_document(index, FILE_SIZES[kind]))
+    elif kind == "photo":
+        size = FILE_SIZES["photo"]
+        message.update(chat=private, caption=_caption(rng, index), photo=[
+            {"file_id": f"thumb{index}-1024", "file_unique_id": f"t{index}", "file_size": 1024},
+            {"file_id": f"photo{index}-{size}", "file_unique_id": f"p{index}", "file_size": size},
+        ])
+    elif kind == "group_mention":
+        caption = f"@{BOT_USERNAME}\n" + _caption(rng, index)
+        message.update(
+            chat=group, caption=caption, document=_document(index, FILE_SIZES[kind]),
+            caption_entities=[{"type": "mention", "offset": 0, "length": len(BOT_USERNAME) + 1}],
+        )
+    elif kind == "group_ignored":
+        message.update(chat=group, text="Обсуждаем кандидатов, бот не нужен")
+    elif kind == "parse_failed":
+        message.update(chat=private, text="Привет! Вот резюме, посмотрите")
+    else:
+        raise ValueError(f"Неизвестный тип update: {kind}")
+
+    return {"update_id": index, "message": message}
+
+
+def make_corpus(count, seed=42, mix=None):
+    """Возвращает список (тип, update) длиной count с долями из mix"""
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds, weights = zip(*mix.items())
+    corpus = []
+    for index in range(1, count + 1):
+        kind = rng.choices(kinds, weights)[0]
+        corpus.append((kind, make_update(kind, index, rng)))
+    return corpus
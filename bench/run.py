@@ -0,0 +1,275 @@
+# 🏋️ Нагрузочный прогон: python -m bench.run --updates 500 --concurrency 16
+import argparse
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.corpus import make_corpus
+from bench.stubs import StubConfig, StubServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк /webhook с заглушками Telegram и Apps Script")
+    parser.add_argument("--updates", type=int, default=500, help="Сколько update'ов отправить")
+    parser.add_argument("--concurrency", type=int, default=16, help="Параллельных запросов к /webhook")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--server-cmd", default=f"{sys.executable} app.py", help="Команда запуска сервера (PORT передаётся через env)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Доп. переменные окружения сервера")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--script-latency", type=float, default=0.5)
+    parser.add_argument("--company-latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.2, help="Разброс задержки, доля от неё")
+    parser.add_argument("--telegram-failure-rate", type=float, default=0.0)
+    parser.add_argument("--script-failure-rate", type=float, default=0.0)
+    parser.add_argument("--quiet-period", type=float, default=3.0, help="Сколько секунд без обращений к заглушкам считать завершением")
+    parser.add_argument("--settle-timeout", type=float, default=300.0, help="Максимум ожидания фоновой обработки")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результат в JSON")
+    parser.add_argument("--compare", help="Сравнить с JSON прошлого прогона")
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+# 📏 Пиковый RSS всего дерева процессов сервера (мастер + воркеры)
+class RssSampler:
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _children(pid):
+        children = []
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    children.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+        return children
+
+    @staticmethod
+    def _rss(pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def _tree_rss(self):
+        total, stack = 0, [self.pid]
+        while stack:
+            pid = stack.pop()
+            total += self._rss(pid)
+            stack.extend(self._children(pid))
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, self._tree_rss())
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if os.path.exists("/proc/self/status"):
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+def start_server(args, stub, workdir):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "TELEGRAM_TOKEN": "bench",
+        "TELEGRAM_API_BASE": stub.base_url,
+        "APPS_SCRIPT_URL": f"{stub.base_url}/script",
+        "COMPANY_SCRIPT_URL": f"{stub.base_url}/company",
+        "OUTBOX_DIR": os.path.join(workdir, "outbox"),
+        "STATE_PATH": os.path.join(workdir, "state.sqlite3"),
+        "SLOW_UPDATE_THRESHOLD": "0",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    log_path = os.path.join(workdir, "server.log")
+    log_file = open(log_path, "wb")
+    process = subprocess.Popen(
+        shlex.split(args.server_cmd), cwd=REPO_ROOT, env=env,
+        stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился при старте, см. {log_path}")
+        try:
+            if requests.get(base_url + "/", timeout=1).status_code == 200:
+                return process, base_url, log_path
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Сервер не ответил за 30 с, см. {log_path}")
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def replay(base_url, corpus, concurrency):
+    local = threading.local()
+    latencies, statuses, errors = [], {}, 0
+    lock = threading.Lock()
+
+    def send(item):
+        nonlocal errors
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        _, update = item
+        started = time.perf_counter()
+        try:
+            response = session.post(base_url + "/webhook", json=update, timeout=120)
+            key = str(response.status_code)
+        except requests.RequestException:
+            key = "exception"
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[key] = statuses.get(key, 0) + 1
+            if key != "200":
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, corpus))
+    return time.perf_counter() - started, sorted(latencies), statuses, errors
+
+
+def wait_until_quiet(stub, quiet_period, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if time.monotonic() - stub.stats.last_activity >= quiet_period:
+            break
+        time.sleep(0.1)
+    return stub.stats.last_activity
+
+
+def report(result, previous=None):
+    keys = [
+        ("webhook_p50_ms", "p50 ответа /webhook, мс"),
+        ("webhook_p95_ms", "p95 ответа /webhook, мс"),
+        ("webhook_p99_ms", "p99 ответа /webhook, мс"),
+        ("webhook_throughput_rps", "Пропускная способность /webhook, req/s"),
+        ("end_to_end_seconds", "До завершения фоновой обработки, с"),
+        ("end_to_end_throughput_ups", "Сквозная пропускная способность, update/s"),
+        ("peak_rss_mb", "Пиковый RSS сервера, МБ"),
+        ("rows_written", "Строк записано в таблицу"),
+    ]
+    print(f"\n🏋️ {result['updates']} update'ов, concurrency={result['concurrency']}, команда: {result['server_cmd']}")
+    for key, title in keys:
+        line = f"  {title:<45} {result[key]:>10}"
+        if previous and key in previous and previous[key]:
+            delta = (result[key] - previous[key]) / previous[key] * 100
+            line += f"   ({delta:+.1f}% к прошлому прогону)"
+        print(line)
+    print(f"  Коды ответов: {result['statuses']}")
+    print(f"  Запросы к заглушкам: {result['stub']['requests']}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    corpus = make_corpus(args.updates, seed=args.seed)
+    stub = StubServer(StubConfig(
+        telegram_latency=args.telegram_latency,
+        script_latency=args.script_latency,
+        company_latency=args.company_latency,
+        jitter=args.jitter,
+        telegram_failure_rate=args.telegram_failure_rate,
+        script_failure_rate=args.script_failure_rate,
+    )).start()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        process, base_url, log_path = start_server(args, stub, workdir)
+        sampler = RssSampler(process.pid).start()
+        try:
+            started = time.monotonic()
+            duration, latencies, statuses, errors = replay(base_url, corpus, args.concurrency)
+            last_activity = wait_until_quiet(stub, args.quiet_period, args.settle_timeout)
+        finally:
+            sampler.stop()
+            stop_server(process)
+            stub.stop()
+
+        end_to_end = max(duration, last_activity - started)
+        stub_stats = stub.stats.snapshot()
+        result = {
+            "updates": args.updates,
+            "concurrency": args.concurrency,
+            "server_cmd": args.server_cmd,
+            "env": args.env,
+            "webhook_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "webhook_p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "webhook_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "webhook_throughput_rps": round(len(latencies) / duration, 2),
+            "end_to_end_seconds": round(end_to_end, 3),
+            "end_to_end_throughput_ups": round(len(latencies) / end_to_end, 2),
+            "peak_rss_mb": round(sampler.peak_bytes / (1024 * 1024), 1),
+            "rows_written": stub_stats["rows_written"],
+            "errors": errors,
+            "statuses": statuses,
+            "stub": stub_stats,
+        }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report(result, previous)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0 if errors == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# 🧪 Локальные заглушки Bot API и Apps Script с настраиваемой задержкой и сбоями
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    """Задержка (latency ± jitter) и доля сбоев для каждой из заглушек"""
+
+    def __init__(self, telegram_latency=0.05, script_latency=0.5, company_latency=0.3,
+                 jitter=0.2, telegram_failure_rate=0.0, script_failure_rate=0.0):
+        self.telegram_latency = telegram_latency
+        self.script_latency = script_latency
+        self.company_latency = company_latency
+        self.jitter = jitter
+        self.telegram_failure_rate = telegram_failure_rate
+        self.script_failure_rate = script_failure_rate
+
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.bytes_received = 0
+        self.rows_written = 0
+        self.last_activity = time.monotonic()
+
+    def record(self, kind, size=0, rows=0):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            self.bytes_received += size
+            self.rows_written += rows
+            self.last_activity = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": dict(self.counts),
+                "bytes_received": self.bytes_received,
+                "rows_written": self.rows_written,
+            }
+
+
+def _make_handler(config, stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _sleep(self, base):
+            if base > 0:
+                time.sleep(max(0.0, base * (1 + random.uniform(-config.jitter, config.jitter))))
+
+        def _reply(self, status, obj=None, body=None):
+            if body is None:
+                body = json.dumps(obj if obj is not None else {}).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            remaining, chunks = length, []
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            return b"".join(chunks)
+
+        def do_GET(self):
+            # getFile: file_path кодирует размер файла — /file/... отдаст столько байт
+            match = re.match(r'^/bot[^/]+/getFile\?file_id=([^&]+)', self.path)
+            if match:
+                self._sleep(config.telegram_latency)
+                stats.record('getFile')
+                if random.random() < config.telegram_failure_rate:
+                    return self._reply(500, {"ok": False})
+                size = int(match.group(1).rsplit('-', 1)[-1]) if '-' in match.group(1) else 1024
+                return self._reply(200, {"ok": True, "result": {"file_path": f"documents/{size}.bin"}})
+
+            match = re.match(r'^/file/bot[^/]+/documents/(\d+)\.bin$', self.path)
+            if match:
+                self._sleep(config.telegram_latency)
+                size = int(match.group(1))
+                stats.record('download', size)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                block = bytes(range(256)) * 256
+                while size > 0:
+                    piece = block[:min(size, len(block))]
+                    self.wfile.write(piece)
+                    size -= len(piece)
+                return
+
+            self._reply(404, {"ok": False, "description": "Not Found"})
+
+        def do_POST(self):
+            body = self._read_body()
+
+            if self.path.startswith('/bot'):
+                method = self.path.rsplit('/', 1)[-1]
+                self._sleep(config.telegram_latency)
+                stats.record(method, len(body))
+                if random.random() < config.telegram_failure_rate:
+                    return self._reply(500, {"ok": False})
+                return self._reply(200, {"ok": True, "result": True})
+
+            if self.path.startswith('/company'):
+                self._sleep(config.company_latency)
+                request = json.loads(body or b'{}')
+                stats.record(request.get('action', 'company'))
+                if request.get('action') == 'get_all_companies':
+                    companies = {str(chat_id): f"Company {chat_id}" for chat_id in range(1, 51)}
+                    return self._reply(200, {"status": "success", "companies": companies})
+                chat_id = int(request.get('chatId', 0))
+                if 0 < chat_id <= 50:
+                    return self._reply(200, {"status": "success", "company": f"Company {chat_id}"})
+                return self._reply(200, {"status": "error", "message": "Company not found"})
+
+            if self.path.startswith('/script'):
+                self._sleep(config.script_latency)
+                if random.random() < config.script_failure_rate:
+                    stats.record('script_failed', len(body))
+                    return self._reply(503, {"status": "error"})
+                request = json.loads(body or b'{}')
+                if request.get('action') == 'batch':
+                    rows = len(request.get('rows', []))
+                    stats.record('script_batch', len(body), rows)
+                    return self._reply(200, {"status": "success", "results": [{"status": "success"}] * rows})
+                stats.record('script_write', len(body), 1)
+                return self._reply(200, {"status": "success"})
+
+            self._reply(404, {"ok": False})
+
+    return Handler
+
+
+class StubServer:
+    """Одна заглушка на случайном порту: /bot..., /file/bot..., /company, /script"""
+
+    def __init__(self, config):
+        self.config = config
+        self.stats = StubStats()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(config, self.stats))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="bench-stub", daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,60 @@
+# 🦄 Продакшен-запуск: gunicorn -c gunicorn.conf.py app:app
+import os
+import signal
+
+# Несколько воркеров делят кэши, дедупликацию и лимиты Telegram только через общее хранилище
+os.environ.setdefault("STATE_BACKEND", "sqlite")
+# /metrics отвечает один из воркеров — он складывает снимки метрик всех воркеров из этого каталога
+os.environ.setdefault("METRICS_DIR", os.path.join("state", "metrics"))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))  # одновременных запросов на воркер
+preload_app = True  # app.py импортируется один раз в мастере, воркеры получают его через fork
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))  # загрузка резюме в Apps Script бывает долгой
+keepalive = 5
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+accesslog = None
+errorlog = "-"
+
+
+# 📈 Снимки метрик прошлого запуска удаляем: счётчики начинаются с нуля вместе с мастером
+def on_starting(server):
+    import glob
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")):
+        os.remove(path)
+
+
+# 🔁 Фоновые потоки (пул update'ов, пачки, отправка в Telegram, outbox) стартуют лениво после fork;
+# здесь запускаем те, что не привязаны к первому запросу
+def post_fork(server, worker):
+    from app import start_background_services
+    start_background_services()
+
+
+# 🚦 По SIGTERM воркер ещё дообрабатывает принятые соединения — вебхук сразу начинает отвечать 503,
+# и Telegram доставит update повторно (уже другому воркеру или после перезапуска).
+# Обработчик ставим здесь: в post_fork его перезаписал бы init_signals воркера
+def post_worker_init(worker):
+    from app import shutting_down
+    gunicorn_handler = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(signum, frame):
+        shutting_down.set()
+        gunicorn_handler(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+# SIGINT/SIGQUIT — быстрая остановка
+def worker_int(worker):
+    from app import shutting_down
+    shutting_down.set()
+
+
+# 🛑 Перед выходом воркер дочищает принятые update'ы, альбомы, пачки и исходящие сообщения.
+# Мастер убивает воркер через graceful_timeout после SIGTERM — оставляем запас на завершение
+def worker_exit(server, worker):
+    from app import drain_background_work
+    drain_background_work(max(1.0, graceful_timeout - 5))
@@ -1 +1,166 @@
+# 🤖 Long-polling через getUpdates — альтернатива вебхуку для узлов без публичного HTTPS
+import os
+import json
+import signal
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+from app import (
+    app,
+    handle_update,
+    http_request,
+    telegram_api_url,
+    start_background_services,
+    drain_background_work,
+    media_groups,
+    HTTP_CONNECT_TIMEOUT,
+    MEDIA_GROUP_WINDOW,
+)
+
+# 🧩 Настройки из переменных окружения
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", 30))  # сколько Telegram держит запрос, если update'ов нет
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", 100))  # update'ов за один запрос (максимум у Telegram — 100)
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", 8))
+POLL_OFFSET_FILE = os.getenv("POLL_OFFSET_FILE", "poll_offset.json")
+POLL_DELETE_WEBHOOK = os.getenv("POLL_DELETE_WEBHOOK", "1") == "1"  # getUpdates не работает при активном вебхуке
+POLL_MAX_ATTEMPTS = int(os.getenv("POLL_MAX_ATTEMPTS", 5))  # после стольких неудач подряд update пропускается
+POLL_RETRY_DELAY = float(os.getenv("POLL_RETRY_DELAY", 5))  # пауза перед повтором пачки с неудачным update
+
+_stopping = False
+_failures = {}  # update_id -> неудачных попыток
+
+
+# 💾 Читает сохранённый offset
+def load_offset():
+    try:
+        with open(POLL_OFFSET_FILE) as f:
+            return json.load(f).get('offset')
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        app.logger.error("❌ Не удалось прочитать %s: %s", POLL_OFFSET_FILE, e)
+        return None
+
+# 💾 Атомарно сохраняет offset, чтобы после перезапуска не потерять и не повторить пачку
+def save_offset(offset):
+    tmp_path = f"{POLL_OFFSET_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"offset": offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, POLL_OFFSET_FILE)
+
+# 📥 Забирает очередную пачку update'ов
+def get_updates(offset):
+    params = {
+        "timeout": POLL_TIMEOUT,
+        "limit": POLL_LIMIT,
+        "allowed_updates": json.dumps(["message", "callback_query"]),
+    }
+    if offset is not None:
+        params["offset"] = offset
+    response = http_request(
+        'GET', telegram_api_url('getUpdates'), 'get_updates',
+        params=params, timeout=(HTTP_CONNECT_TIMEOUT, POLL_TIMEOUT + 10),
+    )
+    result = response.json()
+    if not result.get('ok'):
+        raise RuntimeError(f"getUpdates: {result.get('error_code')} {result.get('description')}")
+    return result['result']
+
+# 💬 Ключ чата: update'ы одного чата обрабатываются по порядку, разные чаты — параллельно
+def chat_key(update):
+    message = update.get('message') or update.get('callback_query', {}).get('message') or {}
+    chat_id = message.get('chat', {}).get('id')
+    return chat_id if chat_id is not None else f"update:{update.get('update_id')}"
+
+def process_chat_updates(updates):
+    """Обрабатывает update'ы чата по порядку; возвращает update_id первого необработанного или None"""
+    for update in updates:
+        update_id = update.get('update_id')
+        try:
+            result, code = handle_update(update)
+        except Exception as e:
+            result, code = {"status": "error", "message": str(e)}, 500
+        if code < 500:
+            _failures.pop(update_id, None)
+            continue
+
+        attempts = _failures[update_id] = _failures.get(update_id, 0) + 1
+        if attempts >= POLL_MAX_ATTEMPTS:
+            _failures.pop(update_id, None)
+            app.logger.error("💥 update %s не обработан за %d попыток — пропускаем: %s", update_id, attempts, result)
+            continue
+        # Остальные update'ы чата не трогаем, чтобы не нарушить порядок: они придут снова вместе с этим
+        app.logger.error("💥 update %s не обработан (попытка %d), повторим: %s", update_id, attempts, result)
+        return update_id
+    return None
+
+def next_offset(updates, failed):
+    """Offset после пачки: за первым неудачным update'ом или за последним в пачке"""
+    if failed:
+        # Telegram вернёт update'ы начиная с первого неудачного; уже обработанные отсеет дедупликация
+        return min(failed)
+    return max(update['update_id'] for update in updates) + 1
+
+def held_offset(offset, buffered):
+    """Telegram считает подтверждёнными все update'ы ниже offset, поэтому offset не заходит за части
+    альбомов, которые ещё в буфере: при падении они придут снова, а до тех пор отсеются как повтор"""
+    return min([offset, *buffered]) if offset is not None else None
+
+# 🔁 Основной цикл
+def run_polling():
+    if POLL_DELETE_WEBHOOK:
+        # drop_pending_updates=False — накопившиеся update'ы заберём через getUpdates
+        http_request('POST', telegram_api_url('deleteWebhook'), 'bot_api', json={"drop_pending_updates": False})
+
+    start_background_services()
+    offset = resume_offset = load_offset()
+    app.logger.info("🤖 Long-polling запущен, offset=%s, воркеров: %d", offset, POLL_WORKERS)
+
+    with ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix="poll") as pool:
+        while not _stopping:
+            try:
+                updates = get_updates(offset)
+            except Exception as e:
+                app.logger.error("❌ Ошибка getUpdates: %s", e)
+                time.sleep(5)
+                continue
+            if not updates:
+                continue
+
+            by_chat = OrderedDict()
+            for update in updates:
+                by_chat.setdefault(chat_key(update), []).append(update)
+            buffered_before = media_groups.pending_update_ids()
+            # Ждём всю пачку и только потом сдвигаем offset — так пачка не потеряется при падении
+            failed = [update_id for update_id in pool.map(process_chat_updates, by_chat.values()) if update_id is not None]
+            resume_offset = next_offset(updates, failed)
+            offset = held_offset(resume_offset, media_groups.pending_update_ids())
+            save_offset(offset)
+            app.logger.info("📦 Обработано update'ов: %d, чатов: %d, offset=%s", len(updates), len(by_chat), offset)
+            if failed:
+                time.sleep(POLL_RETRY_DELAY)
+            elif all(update['update_id'] in buffered_before for update in updates):
+                # Пришли только уже буферизованные части альбомов: не крутим getUpdates вхолостую,
+                # но и не ждём таймера альбома целиком — следующая часть может прийти следующей пачкой
+                media_groups.wait_idle(MEDIA_GROUP_WINDOW / 3)
+
+    drain_background_work()
+    if resume_offset != offset and not media_groups.pending_update_ids():
+        # Альбомы из буфера обработаны при остановке — их части больше не нужны
+        save_offset(resume_offset)
+    app.logger.info("👋 Long-polling остановлен")
+
+def stop_polling(signum, frame):
+    global _stopping
+    _stopping = True
+    app.logger.info("🛑 Останавливаемся после текущей пачки...")
+
+
+# 🚀 Запуск: python main.py
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, stop_polling)
+    signal.signal(signal.SIGINT, stop_polling)
+    run_polling()
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+import app
+from app import MemoryStateStore, TTLCache
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    calls = []
+    companies = {"1": "Ромашка"}
+
+    def fetch(chat_id):
+        calls.append(str(chat_id))
+        if chat_id == "down":
+            raise RuntimeError("HTTP 503")
+        return companies.get(str(chat_id))
+
+    monkeypatch.setattr(app, "fetch_company_by_chat_id", fetch)
+    monkeypatch.setattr(app, "company_cache", TTLCache("company", 100, 60, store=MemoryStateStore()))
+    monkeypatch.setattr(app, "COMPANY_SCRIPT_URL", "https://company.example")
+    monkeypatch.setattr(app, "COMPANY_CACHE_NEGATIVE_TTL", 0.05)
+    return calls
+
+
+def test_found_company_is_cached(lookups):
+    assert app.get_company_by_chat_id(1) == "Ромашка"
+    assert app.get_company_by_chat_id(1) == "Ромашка"
+    assert lookups == ["1"]
+
+
+def test_missing_company_is_cached_for_negative_ttl(lookups):
+    assert app.get_company_by_chat_id(2) is None
+    assert app.get_company_by_chat_id(2) is None
+    assert lookups == ["2"]
+    # Отрицательный ответ живёт COMPANY_CACHE_NEGATIVE_TTL, а не весь TTL кэша
+    time.sleep(0.06)
+    assert app.get_company_by_chat_id(2) is None
+    assert lookups == ["2", "2"]
+
+
+def test_lookup_errors_are_not_cached(lookups):
+    assert app.get_company_by_chat_id("down") is None
+    assert app.get_company_by_chat_id("down") is None
+    assert lookups == ["down", "down"]
+
+
+def test_invalidate_one_chat_or_whole_cache(lookups):
+    app.get_company_by_chat_id(1)
+    app.get_company_by_chat_id(2)
+    app.invalidate_company_cache(1)
+    app.get_company_by_chat_id(1)
+    app.get_company_by_chat_id(2)
+    assert lookups == ["1", "2", "1"]
+    app.invalidate_company_cache()
+    app.get_company_by_chat_id(1)
+    app.get_company_by_chat_id(2)
+    assert lookups == ["1", "2", "1", "1", "2"]
+
+
+def test_invalidate_endpoint_requires_admin_token(lookups, monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(app, "_background_pid", app.os.getpid())
+    client = app.app.test_client()
+    app.get_company_by_chat_id(1)
+    assert client.post("/admin/company-cache/invalidate", json={"chatId": 1}).status_code == 403
+    response = client.post("/admin/company-cache/invalidate", json={"chatId": 1}, headers={"X-Admin-Token": "secret"})
+    assert response.get_json() == {"status": "invalidated", "chatId": 1}
+    app.get_company_by_chat_id(1)
+    assert lookups == ["1", "1"]
+
+
+def test_preload_fills_cache(lookups, monkeypatch):
+    class FakeResponse:
+        status_code = 200
+
+        def json(self):
+            return {"status": "success", "companies": {"7": "Лютик", "8": ""}}
+
+    monkeypatch.setattr(app, "http_request", lambda method, url, endpoint, **kwargs: FakeResponse())
+    assert app.preload_companies() == 2
+    assert app.get_company_by_chat_id(7) == "Лютик"
+    assert lookups == []
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+import app
+from app import MemoryStateStore, TTLCache
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    monkeypatch.setattr(app, "seen_updates", TTLCache("update", 100, 60, store=MemoryStateStore()))
+    handled = []
+    results = {}
+
+    def process_update(update):
+        handled.append(update["update_id"])
+        result = results.get(update["update_id"], ({"status": "ok"}, 200))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(app, "process_update", process_update)
+    return handled, results
+
+
+def test_processed_update_is_skipped_on_redelivery(updates):
+    handled, _ = updates
+    assert app.handle_update({"update_id": 1}) == ({"status": "ok"}, 200)
+    assert app.handle_update({"update_id": 1}) == ({"status": "duplicate"}, 200)
+    assert handled == [1]
+    assert app.seen_updates.get(1) is True
+
+
+def test_update_in_progress_is_skipped(monkeypatch):
+    monkeypatch.setattr(app, "seen_updates", TTLCache("update", 100, 60, store=MemoryStateStore()))
+    started, release = threading.Event(), threading.Event()
+
+    def process_update(update):
+        started.set()
+        release.wait(5)
+        return {"status": "ok"}, 200
+
+    monkeypatch.setattr(app, "process_update", process_update)
+    first = threading.Thread(target=app.handle_update, args=({"update_id": 1},))
+    first.start()
+    started.wait(5)
+    # Telegram повторил доставку, пока первая ещё обрабатывается
+    assert app.seen_updates.get(1) == "processing"
+    assert app.handle_update({"update_id": 1}) == ({"status": "duplicate"}, 200)
+    release.set()
+    first.join(5)
+
+
+def test_failed_update_can_be_redelivered(updates):
+    handled, results = updates
+    results[1] = ({"status": "error"}, 500)
+    results[2] = RuntimeError("boom")
+    assert app.handle_update({"update_id": 1})[1] == 500
+    with pytest.raises(RuntimeError):
+        app.handle_update({"update_id": 2})
+    del results[1], results[2]
+    assert app.handle_update({"update_id": 1}) == ({"status": "ok"}, 200)
+    assert app.handle_update({"update_id": 2}) == ({"status": "ok"}, 200)
+    assert handled == [1, 2, 1, 2]
+
+
+def test_buffered_album_part_stays_in_progress(updates):
+    _, results = updates
+    results[1] = ({"status": "media_group_buffered"}, 200)
+    app.handle_update({"update_id": 1})
+    assert app.seen_updates.get(1) == "processing"
+    app.mark_updates_handled([1])
+    assert app.seen_updates.get(1) is True
+
+
+# ♻️ Повторная отправка того же резюме
+
+def resume_message(file_unique_id, applicant="Иван"):
+    return {
+        "message_id": 1, "chat": {"id": 5, "type": "private"},
+        "caption": f"Соискатель: {applicant}\nПозиция: Python\nКоманда: Backend",
+        "document": {"file_id": "f", "file_unique_id": file_unique_id, "file_name": "cv.pdf"},
+    }
+
+
+@pytest.fixture
+def submissions(monkeypatch):
+    replies, sent = [], []
+    monkeypatch.setattr(app, "accepted_submissions", TTLCache("submission", 100, 60, store=MemoryStateStore()))
+    monkeypatch.setattr(app, "send_telegram_message", lambda chat_id, text: replies.append(text))
+    monkeypatch.setattr(app, "fetch_document", lambda document, parsed_data, index=0: {"fileName": document["file_name"]})
+    monkeypatch.setattr(app, "get_company_by_chat_id", lambda chat_id: None)
+
+    def submit_to_sheet(chat_id, parsed_data, files, submission_key):
+        sent.append(submission_key)
+        app.accepted_submissions.set(submission_key, {"chatId": chat_id})
+        return {"status": "ok"}, 200
+
+    monkeypatch.setattr(app, "submit_to_sheet", submit_to_sheet)
+    return replies, sent
+
+
+def test_same_resume_is_not_submitted_twice(submissions):
+    replies, sent = submissions
+    assert app.process_message(resume_message("u1")) == ({"status": "ok"}, 200)
+    assert app.process_message(resume_message("u1")) == ({"status": "duplicate_submission"}, 200)
+    assert replies == ["✅ Это резюме уже добавлено в таблицу ранее."]
+    # Тот же файл для другого соискателя — другая заявка
+    assert app.process_message(resume_message("u1", applicant="Пётр")) == ({"status": "ok"}, 200)
+    assert len(sent) == 2
@@ -0,0 +1,99 @@
+import io
+import threading
+import time
+
+import pytest
+
+import app
+from app import FileBlob, FileTooLargeError, MemoryStateStore, TTLCache
+
+
+def resume_message(*file_ids):
+    parts = [{"document": {"file_id": file_id, "file_unique_id": file_id, "file_name": f"{file_id}.pdf"}} for file_id in file_ids]
+    message = {"message_id": 1, "chat": {"id": 5, "type": "private"}, "caption": "Позиция: Python\nКоманда: Backend\nСоискатель: Иван"}
+    return [dict(message, **part) for part in parts]
+
+
+class Blob(FileBlob):
+    def __init__(self):
+        super().__init__(io.BytesIO(b"pdf"), 3)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def submission(monkeypatch):
+    state = {"replies": [], "submitted": [], "blobs": [], "company": lambda: "Ромашка", "document": lambda name: None}
+
+    def fetch_document(document, parsed_data, index=0):
+        state["document"](document["file_id"])
+        blob = Blob()
+        state["blobs"].append(blob)
+        return {"fileName": document["file_name"], "base64": blob}
+
+    monkeypatch.setattr(app, "fetch_document", fetch_document)
+    monkeypatch.setattr(app, "get_company_by_chat_id", lambda chat_id: state["company"]())
+    monkeypatch.setattr(app, "send_telegram_message", lambda chat_id, text: state["replies"].append(text))
+
+    def submit_to_sheet(chat_id, parsed_data, files, submission_key):
+        state["submitted"].append((parsed_data.get("Компания"), [f["fileName"] for f in files]))
+        return {"status": "ok"}, 200
+
+    monkeypatch.setattr(app, "submit_to_sheet", submit_to_sheet)
+    monkeypatch.setattr(app, "accepted_submissions", TTLCache("submission", 100, 60, store=MemoryStateStore()))
+    return state
+
+
+def test_company_and_files_are_fetched_concurrently(submission):
+    submission["company"] = lambda: time.sleep(0.2) or "Ромашка"
+    submission["document"] = lambda name: time.sleep(0.2)
+    album = resume_message("a", "b")
+    started = time.monotonic()
+    assert app.process_message(album[0], album=album) == ({"status": "ok"}, 200)
+    assert time.monotonic() - started < 0.35
+    assert submission["submitted"] == [("Ромашка", ["a.pdf", "b.pdf"])]
+
+
+def test_file_past_deadline_is_reported_and_closed_later(submission, monkeypatch):
+    monkeypatch.setattr(app, "SUBMISSION_DEADLINE", 0.1)
+    release = threading.Event()
+    submission["document"] = lambda name: release.wait(5) if name == "b" else None
+    album = resume_message("a", "b")
+    assert app.process_message(album[0], album=album) == ({"status": "file_processing_error"}, 200)
+    assert submission["replies"] == ["❌ Ошибка обработки файла. Попробуйте отправить снова."]
+    assert submission["submitted"] == []
+    # Уже скачанный файл закрыт сразу, опоздавший — когда докачается
+    first = submission["blobs"][0]
+    assert first.closed
+    release.set()
+    deadline = time.monotonic() + 5
+    while len(submission["blobs"]) < 2 or not submission["blobs"][1].closed:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_company_past_deadline_does_not_block_submission(submission, monkeypatch):
+    monkeypatch.setattr(app, "SUBMISSION_DEADLINE", 0.1)
+    release = threading.Event()
+    submission["company"] = lambda: release.wait(5) and "Ромашка"
+    message = resume_message("a")[0]
+    assert app.process_message(message) == ({"status": "ok"}, 200)
+    release.set()
+    # Заявка уходит без компании из таблицы
+    assert submission["submitted"] == [(None, ["a.pdf"])]
+
+
+@pytest.mark.parametrize("error, status, reply", [
+    (FileTooLargeError("11 байт"), "file_too_large", app.file_too_large_message()),
+    (RuntimeError("HTTP 502"), "file_processing_error", "❌ Ошибка обработки файла. Попробуйте отправить снова."),
+])
+def test_file_error_replies_to_chat(submission, error, status, reply):
+    def fail(name):
+        raise error
+
+    submission["document"] = fail
+    assert app.process_message(resume_message("a")[0]) == ({"status": status}, 200)
+    assert submission["replies"] == [reply]
+    assert submission["submitted"] == []
@@ -0,0 +1,93 @@
+import json
+import logging
+
+import pytest
+
+import app
+from app import AsyncLogHandler, JsonLogFormatter, LogText, SamplingFilter
+
+
+def test_log_text_truncates_long_text(monkeypatch):
+    monkeypatch.setattr(app, "LOG_REDACT", False)
+    monkeypatch.setattr(app, "LOG_MAX_TEXT", 5)
+    assert str(LogText("Соискатель: Иван")) == "'Соиск…(+11)'"
+    assert str(LogText("Иван")) == "'Иван'"
+    # Словари выводятся как JSON без экранирования кириллицы
+    assert str(LogText({"a": "б"})) == '{"a":…(+5)'
+    monkeypatch.setattr(app, "LOG_MAX_TEXT", 100)
+    assert str(LogText({"a": "б"})) == '{"a": "б"}'
+
+
+def test_log_text_redacts_personal_data(monkeypatch):
+    monkeypatch.setattr(app, "LOG_REDACT", True)
+    redacted = str(LogText("Соискатель: Иван"))
+    assert "Иван" not in redacted
+    assert redacted.startswith("<16 симв., sha256:")
+    # Одинаковый текст — одинаковый хэш: повторы видны и без самих данных
+    assert str(LogText("Соискатель: Иван")) == redacted != str(LogText("Соискатель: Пётр"))
+
+
+def test_log_text_is_formatted_lazily(monkeypatch):
+    monkeypatch.setattr(app, "LOG_REDACT", False)
+    formatted = []
+
+    class Spy:
+        def __str__(self):
+            formatted.append(True)
+            return "x"
+
+    record = logging.LogRecord("app", logging.DEBUG, __file__, 1, "%s", (LogText(Spy()),), None)
+    assert formatted == []
+    record.getMessage()
+    assert formatted == [True]
+
+
+def test_sampling_filter_keeps_rate_share():
+    sampler = SamplingFilter({logging.INFO: 0.0, logging.DEBUG: 0.5})
+    info = logging.LogRecord("app", logging.INFO, __file__, 1, "info", (), None)
+    warning = logging.LogRecord("app", logging.WARNING, __file__, 1, "warning", (), None)
+    assert not sampler.filter(info) and sampler.filter(warning)
+    assert sampler.sampled_out == 1
+
+
+class Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+@pytest.fixture
+def handler():
+    target = Collect()
+    target.setFormatter(JsonLogFormatter())
+    handler = AsyncLogHandler(target, maxsize=10, sampler=SamplingFilter({}))
+    yield handler, target
+    handler.close()
+
+
+def test_async_handler_writes_json_with_update_context(handler):
+    handler, target = handler
+    logger = logging.getLogger("test_async_handler")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        with app.log_context(update_id=7):
+            app.bind_log_context(chat_id=5)
+            logger.warning("📩 %s", "текст")
+        handler.close()  # дописывает очередь
+    finally:
+        logger.removeHandler(handler)
+    entry = json.loads(target.records[0])
+    assert entry["msg"] == "📩 текст" and entry["level"] == "WARNING"
+    assert entry["update_id"] == 7 and entry["chat_id"] == 5
+
+
+def test_async_handler_drops_when_queue_is_full(handler):
+    handler, _ = handler
+    handler._ensure_started = lambda: None  # без потока-писателя очередь не разбирается
+    for i in range(12):
+        handler.handle(logging.LogRecord("app", logging.WARNING, __file__, 1, "msg %d", (i,), None))
+    assert handler.stats()["queued"] == 10 and handler.stats()["dropped"] == 2
@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+import app
+from app import MediaGroupAggregator, MemoryStateStore
+
+
+def part(message_id, chat_id=5, group="g1", caption=None):
+    message = {"message_id": message_id, "chat": {"id": chat_id}, "media_group_id": group, "document": {"file_id": f"f{message_id}"}}
+    if caption:
+        message["caption"] = caption
+    return message
+
+
+@pytest.fixture
+def albums():
+    handled = []
+    return handled, lambda messages: handled.append([m["message_id"] for m in messages])
+
+
+def test_parts_within_window_become_one_album(albums):
+    handled, handler = albums
+    confirmed = []
+    aggregator = MediaGroupAggregator(0.1, handler, store=MemoryStateStore(), on_handled=confirmed.extend)
+    aggregator.add(part(12), update_id=2)
+    time.sleep(0.05)
+    # Новая часть продлевает окно
+    aggregator.add(part(11), update_id=1)
+    aggregator.add(part(30, chat_id=6), update_id=3)
+    assert aggregator.pending_update_ids() == {1, 2, 3}
+    assert aggregator.wait_idle(5)
+    assert sorted(handled) == [[11, 12], [30]]
+    assert sorted(confirmed) == [1, 2, 3]
+    assert aggregator.pending_update_ids() == set()
+    assert aggregator.stats() == {"buffered": 0, "groups": 2, "parts": 3}
+
+
+def test_parts_in_different_workers_are_handled_once(albums):
+    handled, handler = albums
+    store = MemoryStateStore()
+    first = MediaGroupAggregator(0.1, handler, store=store)
+    second = MediaGroupAggregator(0.1, handler, store=store)
+    first.add(part(1), update_id=1)
+    second.add(part(2), update_id=2)
+    assert first.wait_idle(5) and second.wait_idle(5)
+    assert handled == [[1, 2]]
+    # Альбом забрал один процесс, второй тоже перестаёт держать свои части
+    assert first.pending_update_ids() == set() and second.pending_update_ids() == set()
+
+
+def test_flush_all_handles_buffered_albums_immediately(albums):
+    handled, handler = albums
+    aggregator = MediaGroupAggregator(60, handler, store=MemoryStateStore())
+    aggregator.add(part(1))
+    aggregator.flush_all()
+    assert handled == [[1]]
+    assert aggregator.wait_idle(0)
+
+
+def test_album_is_one_submission_with_caption_from_any_part(monkeypatch):
+    calls = []
+
+    def process_message(message, album=None):
+        calls.append((message, album))
+        return {"status": "ok"}, 200
+
+    monkeypatch.setattr(app, "process_message", process_message)
+    album = [part(1), part(2, caption="Соискатель: Иван"), part(3)]
+    app.process_media_group(album)
+    assert len(calls) == 1
+    primary, messages = calls[0]
+    assert primary["message_id"] == 2 and messages == album
+    # Вложения собираются со всех частей альбома
+    assert [attachment["file_id"] for _, attachment in app.collect_attachments(messages)] == ["f1", "f2", "f3"]
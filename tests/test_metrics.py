@@ -0,0 +1,160 @@
+import time
+
+import pytest
+
+import app
+from app import CircuitBreaker, OutboundScheduler, SheetWriteError
+
+
+def metric(name, **labels):
+    return app.metrics._values.get((name, tuple(sorted(labels.items()))), 0)
+
+
+@pytest.fixture
+def sheet(monkeypatch):
+    reported = []
+    monkeypatch.setattr(app, "report_sheet_result", lambda chat_id, parsed, file_data, error: reported.append(error))
+    monkeypatch.setattr(app, "defer_to_outbox", lambda chat_id, payload, key, message: True)
+    monkeypatch.setattr(app, "apps_script_breaker", CircuitBreaker(3, 60))
+    monkeypatch.setattr(app, "SHEET_BATCH_ENABLED", False)
+    monkeypatch.setattr(app, "OUTBOX_ENABLED", True)
+    return reported
+
+
+@pytest.mark.parametrize("error, status", [
+    (None, "ok"),
+    (SheetWriteError("❌ Ошибка сервера таблицы: 400", retryable=False), "sheet_error"),
+    (SheetWriteError("❌ Ошибка сервера таблицы: 503", retryable=True), "deferred"),
+])
+def test_submit_status_reflects_sheet_result(sheet, monkeypatch, error, status):
+    monkeypatch.setattr(app, "send_to_apps_script", lambda payload: error)
+    before = metric("bot_sheet_writes_total", result=status)
+    assert app.submit_to_sheet(1, {"Соискатель": "Иван"}, []) == ({"status": status}, 200)
+    assert metric("bot_sheet_writes_total", result=status) == before + 1
+    # В outbox ушедшая запись в чат пока не сообщается
+    assert sheet == ([] if status == "deferred" else [error])
+
+
+def test_retryable_error_without_outbox_is_sheet_error(sheet, monkeypatch):
+    monkeypatch.setattr(app, "defer_to_outbox", lambda chat_id, payload, key, message: False)
+    monkeypatch.setattr(app, "send_to_apps_script", lambda payload: SheetWriteError("timeout", retryable=True))
+    assert app.submit_to_sheet(1, {}, []) == ({"status": "sheet_error"}, 200)
+
+
+def test_open_breaker_defers_without_calling_apps_script(sheet, monkeypatch):
+    monkeypatch.setattr(app, "send_to_apps_script", lambda payload: pytest.fail("Apps Script вызван при открытом breaker"))
+    app.apps_script_breaker.record_failure()
+    app.apps_script_breaker.record_failure()
+    app.apps_script_breaker.record_failure()
+    assert app.submit_to_sheet(1, {}, []) == ({"status": "deferred"}, 200)
+
+
+def test_update_counter_uses_sheet_status(sheet, monkeypatch):
+    monkeypatch.setattr(app, "seen_updates", app.TTLCache("update", 100, 60, store=app.MemoryStateStore()))
+    monkeypatch.setattr(app, "process_update", lambda update: app.submit_to_sheet(1, {}, []))
+    monkeypatch.setattr(app, "send_to_apps_script", lambda payload: SheetWriteError("400", retryable=False))
+    ok, failed = metric("bot_updates_total", status="ok"), metric("bot_updates_total", status="sheet_error")
+    app.handle_update({"update_id": 1})
+    assert metric("bot_updates_total", status="ok") == ok
+    assert metric("bot_updates_total", status="sheet_error") == failed + 1
+
+
+def test_render_histogram():
+    registry = app.MetricsRegistry()
+    seconds = registry.histogram("test_seconds", "Тест", buckets=(0.1, 1))
+    registry.observe(seconds, 0.5, stage="a")
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 0' in lines
+    assert 'test_seconds_bucket{stage="a",le="1"} 1' in lines
+    assert 'test_seconds_count{stage="a"} 1' in lines
+
+
+# 🐢 Трассировка медленных update'ов
+
+@pytest.fixture
+def reports(monkeypatch):
+    reports = []
+    monkeypatch.setattr(app.UpdateTrace, "_report", lambda trace: reports.append([stage for stage, _ in trace]))
+    return reports
+
+
+def test_trace_collects_stages_from_io_pool(reports):
+    with app.update_trace("update 1") as outcome:
+        with app.stage_timer("parse_message"):
+            pass
+        app.submit_io(app.record_stage, "download", 0.5).result()
+        outcome["status"] = "ok"
+    # Этапы из потоков io_pool попадают в трассу своего update
+    assert reports == [["parse_message", "download"]]
+
+
+def test_slow_update_is_counted(monkeypatch):
+    monkeypatch.setattr(app, "SLOW_UPDATE_THRESHOLD", 0.01)
+    before = metric("bot_slow_updates_total")
+    with app.update_trace("update 1"):
+        time.sleep(0.02)
+    with app.update_trace("update 2"):
+        pass
+    assert metric("bot_slow_updates_total") == before + 1
+
+
+class FakeResponse:
+    status_code = 200
+
+
+def test_slow_update_report_includes_reply_send(reports, monkeypatch):
+    monkeypatch.setattr(app, "http_request", lambda method, url, endpoint, **kwargs: FakeResponse())
+    monkeypatch.setattr(app, "shared_state", app.MemoryStateStore())
+    scheduler = OutboundScheduler(1)
+    with app.update_trace("update 1"):
+        scheduler.send(1, 'sendMessage', {"chat_id": 1, "text": "ok"})
+    assert scheduler.drain(5)
+    deadline = time.monotonic() + 5
+    while not reports and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert reports == [["reply_send"]]
+
+
+# 🦄 Метрики нескольких воркеров
+
+def test_merge_sums_counters_and_histograms_but_not_dead_gauges():
+    registry = app.MetricsRegistry()
+    total = registry.counter("test_total", "Тест")
+    seconds = registry.histogram("test_seconds", "Тест", buckets=(1,))
+    busy = registry.gauge("test_busy", "Тест")
+    worker = app.MetricsRegistry()
+    worker._metrics = registry._metrics
+    for r in (registry, worker):
+        r.inc(total, status="ok")
+        r.observe(seconds, 0.5)
+        r.inc(busy)
+    merged = registry.merge([(True, registry.snapshot()), (False, worker.snapshot())])
+    assert merged[("test_total", (("status", "ok"),))] == 2
+    assert merged[("test_seconds", ())] == [[2], 1.0, 2]
+    # in-flight завершившегося воркера в сумму не входит
+    assert merged[("test_busy", ())] == 1
+
+
+def test_metrics_endpoint_sums_worker_snapshots(monkeypatch, tmp_path):
+    import json
+    import subprocess
+    import sys
+
+    dead_pid = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True).stdout
+    monkeypatch.setattr(app, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "_background_pid", app.os.getpid())  # без фоновых потоков
+    (tmp_path / "dead.json").write_text(json.dumps({
+        "pid": int(dead_pid),
+        "values": [["bot_updates_total", [["status", "metrics_test"]], 5]],
+        "stats": [["bot_updates_busy", 3]],
+    }))
+    app.metrics.inc(app.UPDATES_TOTAL, status="metrics_test")
+    own = metric("bot_updates_total", status="metrics_test")
+    body = app.app.test_client().get("/metrics").get_data(as_text=True)
+    assert f'bot_updates_total{{status="metrics_test"}} {own + 5}' in body
+    # Гауги /stats — только живых процессов, с меткой worker
+    assert f'bot_updates_busy{{worker="{app.os.getpid()}"}}' in body
+    assert f'worker="{int(dead_pid)}"' not in body
+    # Повторный запрос не заводит процессу второй файл
+    app.app.test_client().get("/metrics")
+    assert len(list(tmp_path.glob("*.json"))) == 2
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+import app
+from app import OutboundScheduler, TokenBucket
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    assert bucket.available_at(now) == now
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.available_at(now) == pytest.approx(now + 0.5)
+    assert bucket.available_at(now + 0.5) == now + 0.5
+    # Больше capacity не накапливается
+    bucket.take(now + 0.5)
+    assert bucket.available_at(now + 100) == now + 100
+    assert bucket.tokens == 2
+
+
+class FakeResponse:
+    status_code = 200
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    calls = []
+
+    def fake_request(method, url, endpoint, json=None, **kwargs):
+        if url.endswith('answerCallbackQuery'):
+            time.sleep(0.1)
+        calls.append((time.monotonic(), json))
+        return FakeResponse()
+
+    monkeypatch.setattr(app, "http_request", fake_request)
+    monkeypatch.setattr(app, "shared_state", app.MemoryStateStore())
+    return calls
+
+
+def test_scheduler_respects_chat_rate(sent, monkeypatch):
+    monkeypatch.setattr(app, "TELEGRAM_CHAT_RATE", 20)
+    scheduler = OutboundScheduler(2)
+    for i in range(3):
+        scheduler.send(1, 'sendMessage', {"chat_id": 1, "text": str(i)})
+    assert scheduler.drain(5)
+    times = [at for at, _ in sent]
+    assert [payload["text"] for _, payload in sent] == ["0", "1", "2"]
+    assert times[2] - times[0] >= 2 / 20 * 0.9
+
+
+def test_scheduler_merges_consecutive_texts(sent):
+    scheduler = OutboundScheduler(1)
+    # Пока первый запрос в пути, остальные успевают склеиться
+    scheduler.send(None, 'answerCallbackQuery', {"callback_query_id": "1"})
+    for text in ("a", "b"):
+        scheduler.send(5, 'sendMessage', {"chat_id": 5, "text": text}, mergeable=True)
+    assert scheduler.drain(5)
+    assert [payload["text"] for _, payload in sent if "text" in payload] == ["a\n\nb"]
+    assert scheduler.stats()["merged"] == 1
+
+
+class RateLimited:
+    status_code = 429
+
+    def json(self):
+        return {"ok": False, "parameters": {"retry_after": 0.1}}
+
+
+def test_scheduler_waits_retry_after_on_429_and_drops_on_400(monkeypatch):
+    monkeypatch.setattr(app, "shared_state", app.MemoryStateStore())
+    replies = {"1": [RateLimited(), FakeResponse()], "2": [type("BadRequest", (), {"status_code": 400})()]}
+    calls = []
+
+    def fake_request(method, url, endpoint, json=None, **kwargs):
+        calls.append((time.monotonic(), json["text"]))
+        return replies[json["text"]].pop(0)
+
+    monkeypatch.setattr(app, "http_request", fake_request)
+    scheduler = OutboundScheduler(1)
+    scheduler.send(1, 'sendMessage', {"chat_id": 1, "text": "1"})
+    scheduler.send(2, 'sendMessage', {"chat_id": 2, "text": "2"})
+    assert scheduler.drain(5)
+    retries = [at for at, text in calls if text == "1"]
+    assert len(retries) == 2 and retries[1] - retries[0] >= 0.09
+    # 400 не повторяется
+    assert [text for _, text in calls].count("2") == 1
+    stats = scheduler.stats()
+    assert stats["rate_limited"] == 1 and stats["sent"] == 1 and stats["dropped"] == 1
@@ -0,0 +1,151 @@
+import io
+import threading
+import time
+
+import pytest
+
+import app
+from app import CircuitBreaker, FileBlob, SheetOutbox
+
+
+# 🔌 Circuit breaker
+
+def test_breaker_opens_after_threshold_and_probes_once():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow() and breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == 'half_open'
+    # Пока пробный запрос не ответил, остальные не пропускаются
+    assert not breaker.allow()
+
+
+def test_breaker_reopens_when_probe_fails():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and breaker.stats()["opens"] == 2
+
+
+def test_breaker_closes_on_success_and_calls_on_close():
+    closed = threading.Event()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05, on_close=closed.set)
+    breaker.record_success()
+    assert not closed.is_set()
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.failures == 0 and closed.is_set()
+
+
+# 📥 Outbox
+
+@pytest.fixture
+def outbox(tmp_path):
+    return SheetOutbox(str(tmp_path), max_attempts=3, max_age=3600, retry_delay=0.05)
+
+
+def test_manual_claim_ignores_backoff_but_not_dead_letter(outbox):
+    waiting = outbox.put(1, {"data": {}}, "a", "timeout")
+    dead = outbox.put(2, {"data": {}}, "b", "timeout")
+    outbox.release(outbox.claim(waiting)["id"], "timeout")
+    outbox.release(outbox.claim(dead)["id"], "timeout")
+    outbox.release(outbox.claim(dead)["id"], "timeout")
+    assert outbox.pending_count() == 1 and outbox.dead_count() == 1
+    # Фоновый поток ждёт паузы после неудачи, ручной replay — нет
+    assert outbox.claim_next() is None
+    assert outbox.claim_next(due_only=False)["id"] == waiting
+    assert outbox.claim_next(due_only=False) is None
+
+
+def test_cli_replay_sends_rows_waiting_for_backoff(outbox, monkeypatch):
+    entry_id = outbox.put(1, {"data": {}}, "a", "timeout")
+    outbox.release(outbox.claim_next()["id"], "timeout")
+    replayed = []
+
+    def replay(entry):
+        replayed.append(entry["id"])
+        outbox.remove(entry["id"])
+
+    monkeypatch.setattr(app, "sheet_outbox", outbox)
+    monkeypatch.setattr(app, "replay_outbox_entry", replay)
+    result = app.app.test_cli_runner().invoke(args=["outbox", "replay"])
+    assert result.exit_code == 0, result.output
+    assert replayed == [entry_id]
+    assert f"#{entry_id}: отправлено" in result.output
+
+
+def test_cli_replay_reports_when_nothing_to_send(outbox, monkeypatch):
+    monkeypatch.setattr(app, "sheet_outbox", outbox)
+    result = app.app.test_cli_runner().invoke(args=["outbox", "replay"])
+    assert "Нечего отправлять" in result.output
+
+
+def test_outbox_claim_is_exclusive(outbox):
+    entry_id = outbox.put(1, {"data": {}}, "key", "timeout")
+    entry = outbox.claim_next()
+    assert entry["id"] == entry_id
+    assert outbox.claim_next() is None
+    assert outbox.claim(entry_id) is None
+
+
+def test_outbox_failed_entry_does_not_block_later_ones(outbox):
+    first = outbox.put(1, {"data": {}}, "a", "timeout")
+    second = outbox.put(2, {"data": {}}, "b", "timeout")
+    assert not outbox.release(outbox.claim_next()["id"], "timeout")
+    assert outbox.claim_next()["id"] == second
+    time.sleep(0.06)
+    assert outbox.claim_next()["id"] == first
+
+
+def test_outbox_dead_letters_after_max_attempts(outbox):
+    entry_id = outbox.put(1, {"data": {}}, "a", "timeout")
+    assert not outbox.release(outbox.claim_next()["id"], "timeout")
+    time.sleep(0.06)
+    assert outbox.release(outbox.claim_next()["id"], "timeout")
+    assert outbox.pending_count() == 0 and outbox.dead_count() == 1
+    assert outbox.claim_next() is None
+    # Вручную запись из dead-letter взять можно
+    assert outbox.claim(entry_id)["dead_at"] is not None
+
+
+def test_outbox_dead_letters_old_entries(tmp_path):
+    outbox = SheetOutbox(str(tmp_path), max_attempts=100, max_age=0, retry_delay=0)
+    outbox.put(1, {"data": {}}, "a", "timeout")
+    assert outbox.release(outbox.claim_next()["id"], "timeout")
+
+
+def test_outbox_keeps_files(outbox):
+    content = b"%PDF-1.4 resume"
+    entry_id = outbox.put(1, {"file": FileBlob(io.BytesIO(content), len(content))}, "a", "timeout")
+    payload = outbox.load_payload(outbox.claim(entry_id))
+    assert payload["file"].file.read() == content
+    payload["file"].close()
+    outbox.remove(entry_id)
+    assert outbox.get(entry_id) is None
+
+
+def test_deferred_row_is_replayed_and_reported(outbox, monkeypatch):
+    replies, reported, sent = [], [], []
+    monkeypatch.setattr(app, "sheet_outbox", outbox)
+    monkeypatch.setattr(app, "OUTBOX_ENABLED", True)
+    monkeypatch.setattr(app, "send_telegram_message", lambda chat_id, text: replies.append(text))
+    monkeypatch.setattr(app, "report_sheet_result", lambda chat_id, parsed, file_data, error: reported.append(parsed))
+    monkeypatch.setattr(app, "accepted_submissions", app.TTLCache("submission", 100, 60, store=app.MemoryStateStore()))
+    content = b"%PDF-1.4 resume"
+    payload = {"data": {"Соискатель": "Иван"}, "file": {"base64": FileBlob(io.BytesIO(content), len(content))}}
+    assert app.defer_to_outbox(5, payload, "key", "timeout")
+    assert replies[0].startswith("⏳ Таблица временно недоступна")
+
+    monkeypatch.setattr(app, "send_to_apps_script", lambda payload: sent.append(payload["file"]["base64"].file.read()))
+    assert app.replay_outbox_entry(outbox.claim_next()) is None
+    # Файл отправлен из outbox, запись удалена, резюме запомнено для дедупликации
+    assert sent == [content] and reported == [{"Соискатель": "Иван"}]
+    assert outbox.pending_count() == 0
+    assert app.accepted_submissions.get("key") is not app._MISSING
@@ -0,0 +1,110 @@
+import json
+import time
+
+import pytest
+
+import app
+import main
+from app import MediaGroupAggregator, MemoryStateStore, TTLCache
+
+
+class FakeTelegram:
+    """getUpdates как у Telegram: отдаёт пришедшие update'ы с update_id >= offset"""
+
+    def __init__(self, arrivals, stop_when):
+        self.arrivals = list(arrivals)  # update'ы, которые «приходят» к очередному вызову
+        self.stop_when = stop_when
+        self.pending = []
+        self.offsets = []
+
+    def get_updates(self, offset):
+        self.offsets.append(offset)
+        if self.arrivals:
+            self.pending.extend(self.arrivals.pop(0))
+        else:
+            time.sleep(0.02)  # long polling без новых update'ов
+        if self.stop_when(offset) or len(self.offsets) > 500:
+            main._stopping = True
+            return []
+        return [update for update in self.pending if offset is None or update['update_id'] >= offset]
+
+
+def album_part(update_id, message_id, caption=None):
+    message = {"message_id": message_id, "chat": {"id": 5}, "media_group_id": "g1", "document": {"file_id": f"f{message_id}"}}
+    if caption:
+        message["caption"] = caption
+    return {"update_id": update_id, "message": message}
+
+
+@pytest.fixture
+def polling(monkeypatch, tmp_path):
+    albums = []
+    aggregator = MediaGroupAggregator(
+        0.2, lambda messages: albums.append([m['message_id'] for m in messages]),
+        store=MemoryStateStore(), on_handled=app.mark_updates_handled,
+    )
+    monkeypatch.setattr(app, "media_groups", aggregator)
+    monkeypatch.setattr(main, "media_groups", aggregator)
+    monkeypatch.setattr(app, "seen_updates", TTLCache("update", 1000, 60, store=MemoryStateStore()))
+    monkeypatch.setattr(main, "MEDIA_GROUP_WINDOW", 0.2)
+    monkeypatch.setattr(main, "POLL_OFFSET_FILE", str(tmp_path / "offset.json"))
+    monkeypatch.setattr(main, "POLL_DELETE_WEBHOOK", False)
+    monkeypatch.setattr(main, "POLL_RETRY_DELAY", 0)
+    monkeypatch.setattr(main, "start_background_services", lambda: None)
+    monkeypatch.setattr(main, "drain_background_work", aggregator.flush_all)
+    monkeypatch.setattr(main, "_stopping", False)
+    monkeypatch.setattr(main, "_failures", {})
+    return albums
+
+
+def saved_offset():
+    with open(main.POLL_OFFSET_FILE) as f:
+        return json.load(f)["offset"]
+
+
+def test_album_split_across_responses_is_one_submission(polling, monkeypatch):
+    telegram = FakeTelegram(
+        [[album_part(1, 10, caption="Соискатель: Иван")], [album_part(2, 11)]],
+        stop_when=lambda offset: offset == 3,
+    )
+    monkeypatch.setattr(main, "get_updates", telegram.get_updates)
+    main.run_polling()
+    assert polling == [[10, 11]]
+    # Пока часть альбома в буфере, offset её не подтверждает
+    assert telegram.offsets[:3] == [None, 1, 1]
+    assert saved_offset() == 3
+
+
+def test_offset_held_at_buffered_parts_survives_shutdown(polling, monkeypatch):
+    telegram = FakeTelegram([[album_part(1, 10, caption="x")]], stop_when=lambda offset: offset == 1)
+    monkeypatch.setattr(main, "get_updates", telegram.get_updates)
+    # Останавливаемся, пока альбом в буфере: при остановке он обрабатывается, и offset уходит за него
+    main.run_polling()
+    assert polling == [[10]]
+    assert saved_offset() == 2
+
+
+def test_failed_update_stops_chat_and_is_retried(monkeypatch):
+    monkeypatch.setattr(main, "_failures", {})
+    monkeypatch.setattr(main, "POLL_MAX_ATTEMPTS", 2)
+    handled = []
+
+    def handle_update(update):
+        handled.append(update['update_id'])
+        return ({"status": "error"}, 500) if update['update_id'] == 2 else ({"status": "ok"}, 200)
+
+    monkeypatch.setattr(main, "handle_update", handle_update)
+    updates = [{"update_id": i} for i in (1, 2, 3)]
+    assert main.process_chat_updates(updates) == 2
+    assert handled == [1, 2]
+    # После POLL_MAX_ATTEMPTS неудач update пропускается, остальные идут дальше
+    assert main.process_chat_updates(updates) is None
+    assert handled == [1, 2, 1, 2, 3]
+
+
+def test_next_offset():
+    updates = [{"update_id": i} for i in (5, 6, 7)]
+    assert main.next_offset(updates, []) == 8
+    assert main.next_offset(updates, [7, 6]) == 6
+    assert main.held_offset(8, {6}) == 6
+    assert main.held_offset(None, {6}) is None
@@ -0,0 +1,90 @@
+import json
+import os
+
+import pytest
+
+import app
+from app import CompiledPositions, PositionRegistry
+
+CONFIG = {
+    "positions": [
+        {"id": "PY", "label": "Python", "position": "Python Dev", "team": "Core", "vacancy_url": "https://example/py"},
+        {"id": "QA", "position": "QA", "team": "Core", "template": "Позиция: QA\nСоискатель: "},
+    ],
+    "template_order": ["QA", "PY", "GONE"],
+}
+
+
+def test_callbacks_are_precomputed():
+    compiled = CompiledPositions(CONFIG)
+    assert compiled.callback_reply("template_PY").startswith("Позиция: Python Dev\nКоманда: Core\n")
+    assert compiled.callback_reply("template_QA") == "Позиция: QA\nСоискатель: "
+    assert compiled.callback_reply("vacancy_PY") == "📄 Требования по вакансии: https://example/py"
+    assert compiled.callback_reply("vacancy_QA") == "📄 Требования по вакансии: Ссылка не найдена."
+    assert compiled.callback_reply("template_GONE") == "Шаблон не найден."
+
+
+def test_keyboards_are_serialised_in_configured_order():
+    compiled = CompiledPositions(CONFIG)
+    prompt, keyboard, status = compiled.commands[f"/template@{app.BOT_USERNAME}"]
+    assert status == "inline_template_sent"
+    # Неизвестные id из порядка пропускаются, без label подписью служит id
+    assert json.loads(keyboard) == {"inline_keyboard": [
+        [{"text": "QA", "callback_data": "template_QA"}],
+        [{"text": "Python", "callback_data": "template_PY"}],
+    ]}
+    _, keyboard, _ = compiled.commands[f"/vacancy@{app.BOT_USERNAME}"]
+    assert [row[0]["callback_data"] for row in json.loads(keyboard)["inline_keyboard"]] == ["vacancy_PY", "vacancy_QA"]
+
+
+def write_config(path, config, mtime):
+    path.write_text(json.dumps(config), encoding="utf-8")
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_registry_reloads_changed_file_and_keeps_old_on_error(tmp_path):
+    path = tmp_path / "positions.json"
+    write_config(path, CONFIG, 1_000_000_000)
+    registry = PositionRegistry(str(path), reload_interval=0)
+    first = registry.current()
+    assert "template_PY" in first.callbacks
+    # Файл не менялся — тот же объект, без перечитывания
+    assert registry.current() is first and registry.reloads == 1
+
+    write_config(path, {"positions": [{"id": "GO", "position": "Go", "team": "Core"}]}, 2_000_000_000)
+    assert set(registry.current().callbacks) == {"template_GO"}
+    assert registry.reloads == 2
+
+    path.write_text("{broken", encoding="utf-8")
+    os.utime(path, ns=(3_000_000_000, 3_000_000_000))
+    assert set(registry.current().callbacks) == {"template_GO"}
+    assert registry.reload_errors == 1
+
+
+def test_registry_checks_file_at_most_once_per_interval(tmp_path):
+    path = tmp_path / "positions.json"
+    write_config(path, CONFIG, 1_000_000_000)
+    registry = PositionRegistry(str(path), reload_interval=60)
+    registry.current()
+    write_config(path, {"positions": []}, 2_000_000_000)
+    assert "template_PY" in registry.current().callbacks
+
+
+@pytest.fixture
+def replies(monkeypatch, tmp_path):
+    path = tmp_path / "positions.json"
+    write_config(path, CONFIG, 1_000_000_000)
+    monkeypatch.setattr(app, "positions", PositionRegistry(str(path), reload_interval=0))
+    sent = []
+    monkeypatch.setattr(app, "send_telegram_message", lambda chat_id, text: sent.append(text))
+    monkeypatch.setattr(app, "send_telegram_reply_markup", lambda chat_id, text, markup: sent.append((text, json.loads(markup))))
+    monkeypatch.setattr(app, "answer_callback_query", lambda callback_id: sent.append(("answered", callback_id)))
+    return sent
+
+
+def test_commands_and_callbacks_are_routed_through_registry(replies):
+    message = {"message_id": 1, "chat": {"id": 5, "type": "group"}, "text": f"/vacancy@{app.BOT_USERNAME}"}
+    assert app.process_message(message) == ({"status": "inline_vacancy_sent"}, 200)
+    callback = {"callback_query": {"id": "c1", "data": "vacancy_PY", "message": {"chat": {"id": 5}}}}
+    assert app.process_update(callback) == ({"status": "callback_handled"}, 200)
+    assert replies[1:] == ["📄 Требования по вакансии: https://example/py", ("answered", "c1")]
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+import app
+from app import CircuitBreaker, SheetBatcher, SheetWriteError
+
+
+class HtmlResponse:
+    status_code = 200
+    text = "<html>Google Apps Script: ошибка</html>"
+
+    def json(self):
+        raise ValueError("Expecting value")
+
+
+def test_non_json_200_is_not_retried_and_not_a_breaker_failure(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    monkeypatch.setattr(app, "apps_script_breaker", breaker)
+    monkeypatch.setattr(app, "post_apps_script", lambda payload: HtmlResponse())
+    errors = app.send_batch_to_apps_script([{}, {}])
+    assert len(errors) == 2
+    # Пачка могла записаться — повтор из outbox задвоил бы строки
+    assert all(isinstance(error, SheetWriteError) and not error.retryable for error in errors)
+    assert breaker.state == 'closed' and breaker.failures == 0
+
+
+def test_network_error_is_retryable_breaker_failure(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    monkeypatch.setattr(app, "apps_script_breaker", breaker)
+
+    def post(payload):
+        raise ConnectionError("reset")
+
+    monkeypatch.setattr(app, "post_apps_script", post)
+    errors = app.send_batch_to_apps_script([{}])
+    assert errors[0].retryable and breaker.state == 'open'
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, result):
+        self.result = result
+
+    def json(self):
+        return self.result
+
+
+def test_batch_results_are_mapped_per_row(monkeypatch):
+    monkeypatch.setattr(app, "post_apps_script", lambda payload: FakeResponse(
+        {"status": "success", "results": [{"status": "success"}, {"status": "error", "message": "дубль"}]}
+    ))
+    ok, failed = app.send_batch_to_apps_script([{}, {}])
+    assert ok is None
+    assert not failed.retryable and "дубль" in failed.message
+
+
+@pytest.mark.parametrize("results", [None, [], [{"status": "success"}], "ok", [{"status": "success"}, "ok"]])
+def test_malformed_batch_result_is_not_success(monkeypatch, results):
+    monkeypatch.setattr(app, "post_apps_script", lambda payload: FakeResponse({"status": "success", "results": results}))
+    errors = app.send_batch_to_apps_script([{}, {}])
+    assert len(errors) == 2
+    assert all(isinstance(error, SheetWriteError) and not error.retryable for error in errors)
+
+
+def test_rejected_batch_falls_back_to_single_rows(monkeypatch):
+    monkeypatch.setattr(app, "post_apps_script", lambda payload: FakeResponse({"status": "error", "message": "Unknown action"}))
+    sent = []
+    monkeypatch.setattr(app, "send_to_apps_script", lambda row: sent.append(row))
+    assert app.send_batch_to_apps_script([{"n": 1}, {"n": 2}]) == [None, None]
+    assert sent == [{"n": 1}, {"n": 2}]
+
+
+# 📦 Пачки
+
+@pytest.fixture
+def batches(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, "send_batch_to_apps_script", lambda rows: sent.append(rows) or [None] * len(rows))
+    return sent
+
+
+def _submit(batcher, count):
+    done = []
+    for i in range(count):
+        batcher.submit({"n": i}, done.append)
+    return done
+
+
+def _wait(done, count):
+    deadline = time.monotonic() + 5
+    while len(done) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return done
+
+
+def test_batcher_flushes_when_rows_limit_reached(batches):
+    batcher = SheetBatcher(window=60, max_rows=3, max_bytes=10 ** 9)
+    assert _wait(_submit(batcher, 3), 3) == [None] * 3
+    assert batches == [[{"n": 0}, {"n": 1}, {"n": 2}]]
+    assert batcher.flush_reasons["rows"] == 1
+
+
+def test_batcher_flushes_when_bytes_limit_reached(batches):
+    batcher = SheetBatcher(window=60, max_rows=100, max_bytes=1)
+    _wait(_submit(batcher, 2), 2)
+    # Строка больше лимита уходит одна, не застревая
+    assert [len(rows) for rows in batches] == [1, 1]
+    assert batcher.flush_reasons["bytes"] == 2
+
+
+def test_batcher_flushes_after_window(batches):
+    batcher = SheetBatcher(window=0.05, max_rows=100, max_bytes=10 ** 9)
+    assert _wait(_submit(batcher, 2), 2) == [None, None]
+    assert batcher.flush_reasons["window"] == 1
+
+
+def test_batcher_flush_sends_without_waiting_for_window(batches):
+    batcher = SheetBatcher(window=60, max_rows=100, max_bytes=10 ** 9)
+    done = _submit(batcher, 2)
+    assert batcher.flush(5) and done == [None, None]
+    assert batcher.flush_reasons["shutdown"] == 1
@@ -0,0 +1,104 @@
+import multiprocessing
+import threading
+
+import pytest
+
+from app import _MISSING, MemoryStateStore, SqliteStateStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "state.sqlite3")
+
+
+def _race(func, count=8):
+    """Запускает func в count потоках одновременно и возвращает результаты"""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(i):
+        barrier.wait()
+        results[i] = func(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_add_is_atomic_across_connections(db_path):
+    # Отдельный объект на поток — как отдельные воркеры gunicorn с одним файлом
+    results = _race(lambda i: SqliteStateStore(db_path).add("update", 42, i, 60, 100))
+    assert results.count(True) == 1
+    assert SqliteStateStore(db_path).get("update", 42) == results.index(True)
+
+
+def test_update_does_not_lose_increments(db_path):
+    def increment(_):
+        store = SqliteStateStore(db_path)
+        for _ in range(20):
+            store.update("counter", "n", lambda value: 1 if value is _MISSING else value + 1, 60, 100)
+
+    _race(increment)
+    assert SqliteStateStore(db_path).get("counter", "n") == 8 * 20
+
+
+def test_pop_with_condition_hands_value_to_one_caller(db_path):
+    SqliteStateStore(db_path).set("album", "g1", {"parts": 3}, 60, 100)
+    results = _race(lambda i: SqliteStateStore(db_path).pop("album", "g1", when=lambda value: value["parts"] == 3))
+    assert [result for result in results if result is not _MISSING] == [{"parts": 3}]
+
+
+def test_pop_leaves_value_when_condition_is_false(db_path):
+    store = SqliteStateStore(db_path)
+    store.set("album", "g1", {"parts": 1}, 60, 100)
+    assert store.pop("album", "g1", when=lambda value: value["parts"] == 3) is _MISSING
+    assert store.get("album", "g1") == {"parts": 1}
+
+
+def test_take_tokens_is_shared_between_connections(db_path):
+    limits = [("telegram:chat:1", 0.001, 1), ("telegram:global", 0.001, 3)]
+    first, second = SqliteStateStore(db_path), SqliteStateStore(db_path)
+    assert first.take_tokens(limits) == 0
+    # Ведро чата пусто — токен не выдаётся и из общего ведра ничего не списывается
+    assert second.take_tokens(limits) > 0
+    other_chat = [("telegram:chat:2", 0.001, 1), ("telegram:global", 0.001, 3)]
+    assert second.take_tokens(other_chat) == 0
+    assert first.take_tokens([("telegram:chat:3", 0.001, 1), ("telegram:global", 0.001, 3)]) == 0
+    assert second.take_tokens([("telegram:chat:4", 0.001, 1), ("telegram:global", 0.001, 3)]) > 0
+
+
+def _add_in_process(db_path, key, results):
+    results.put(SqliteStateStore(db_path).add("update", key, True, 60, 100))
+
+
+def test_add_is_atomic_across_processes(db_path):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=_add_in_process, args=(db_path, 7, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert sorted(results.get() for _ in processes) == [False, False, False, True]
+
+
+def test_expired_entry_can_be_added_again(db_path):
+    store = SqliteStateStore(db_path)
+    assert store.add("update", 1, "processing", -1, 100)
+    assert store.add("update", 1, True, 60, 100)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, db_path):
+    return MemoryStateStore() if request.param == "memory" else SqliteStateStore(db_path)
+
+
+def test_backends_have_same_semantics(store):
+    assert store.add("ns", "a", 1, 60, 10)
+    assert not store.add("ns", "a", 2, 60, 10)
+    assert store.update("ns", "a", lambda value: value + 1, 60, 10) == 2
+    assert store.pop("ns", "a") == 2
+    assert store.get("ns", "a") is _MISSING
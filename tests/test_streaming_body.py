@@ -0,0 +1,71 @@
+import base64
+import io
+import json
+
+import pytest
+
+import app
+from app import FileBlob, FileTooLargeError, StreamingJsonBody
+
+
+def test_streaming_body_round_trip():
+    content = bytes(range(256)) * 1000 + b"tail"
+    payload = {"data": {"Соискатель": "Иван"}, "files": [{"name": "cv.pdf", "content": FileBlob(io.BytesIO(content), len(content))}]}
+    body = StreamingJsonBody(payload)
+    raw = b"".join(body)
+    assert len(raw) == len(body)
+    decoded = json.loads(raw)
+    assert decoded["data"] == {"Соискатель": "Иван"}
+    assert base64.b64decode(decoded["files"][0]["content"]) == content
+    # Повторный проход (ретрай urllib3) отдаёт то же самое
+    assert b"".join(body) == raw
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, app.BASE64_CHUNK_SIZE + 1])
+def test_streaming_body_length_matches_for_any_size(size):
+    body = StreamingJsonBody({"file": FileBlob(io.BytesIO(b"x" * size), size)})
+    assert len(b"".join(body)) == len(body)
+
+
+# 📥 Скачивание по частям
+
+class FakeDownload:
+    status_code = 200
+
+    def __init__(self, chunks, content_length=None):
+        self.chunks = chunks
+        self.headers = {} if content_length is None else {"Content-Length": str(content_length)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+
+
+@pytest.fixture
+def download(monkeypatch):
+    def serve(chunks, content_length=None):
+        monkeypatch.setattr(app, "http_request", lambda method, url, endpoint, **kwargs: FakeDownload(chunks, content_length))
+        return app.download_file("documents/cv.pdf")
+    monkeypatch.setattr(app, "MAX_FILE_SIZE", 10)
+    monkeypatch.setattr(app, "FILE_SPOOL_THRESHOLD", 4)
+    return serve
+
+
+def test_download_spools_large_files_to_disk(download):
+    blob = download([b"abc", b"def"])
+    assert blob.size == 6 and blob.file._rolled
+    blob.file.seek(0)
+    assert blob.file.read() == b"abcdef"
+    blob.close()
+
+
+@pytest.mark.parametrize("chunks, content_length", [([b"x" * 11], 11), ([b"x" * 6, b"x" * 6], None)])
+def test_download_stops_at_size_limit(download, chunks, content_length):
+    # Лимит проверяется и по Content-Length, и по ходу загрузки, если заголовка нет
+    with pytest.raises(FileTooLargeError):
+        download(chunks, content_length)
@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+import app
+from app import UpdateWorkerPool
+
+
+def test_pool_processes_updates_and_counts_failures():
+    handled = []
+
+    def handler(update):
+        handled.append(update["update_id"])
+        if update["update_id"] == 2:
+            raise RuntimeError("boom")
+        return {"status": "ok"}, 500 if update["update_id"] == 3 else 200
+
+    pool = UpdateWorkerPool(handler, workers=2, maxsize=10)
+    for i in (1, 2, 3):
+        assert pool.submit({"update_id": i})
+    assert pool.drain(5)
+    assert sorted(handled) == [1, 2, 3]
+    stats = pool.stats()
+    assert stats["processed"] == 3 and stats["failed"] == 2 and stats["busy"] == 0
+
+
+def test_pool_rejects_when_queue_is_full():
+    release = threading.Event()
+    started = threading.Event()
+
+    def handler(update):
+        started.set()
+        release.wait(5)
+        return {"status": "ok"}, 200
+
+    pool = UpdateWorkerPool(handler, workers=1, maxsize=1)
+    assert pool.submit({"update_id": 1})
+    started.wait(5)
+    # Первый update в работе, второй ждёт в очереди, третьему места нет
+    assert pool.submit({"update_id": 2})
+    assert not pool.submit({"update_id": 3})
+    assert not pool.drain(0.05)
+    release.set()
+    assert pool.drain(5)
+    assert pool.stats()["rejected"] == 1
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    queued = []
+    pool = UpdateWorkerPool(queued.append, workers=1, maxsize=1)
+    pool._ensure_started = lambda: None  # без потоков: update остаётся в очереди
+    monkeypatch.setattr(app, "update_pool", pool)
+    monkeypatch.setattr(app, "INGEST_MODE", "queue")
+    monkeypatch.setattr(app, "WEBHOOK_SECRET", "")
+    monkeypatch.setattr(app, "shutting_down", threading.Event())
+    monkeypatch.setattr(app, "_background_pid", app.os.getpid())
+    return app.app.test_client()
+
+
+def test_webhook_acknowledges_before_processing(webhook):
+    response = webhook.post("/webhook", json={"update_id": 1})
+    assert response.status_code == 200 and response.get_json() == {"status": "queued"}
+    assert app.update_pool.queue.qsize() == 1
+    # Очередь полна — 503, и Telegram повторит доставку
+    response = webhook.post("/webhook", json={"update_id": 2})
+    assert response.status_code == 503 and response.get_json() == {"status": "queue_full"}
+
+
+def test_webhook_refuses_updates_while_shutting_down(webhook):
+    app.shutting_down.set()
+    response = webhook.post("/webhook", json={"update_id": 1})
+    assert response.status_code == 503 and response.get_json() == {"status": "shutting_down"}
+    assert app.update_pool.queue.qsize() == 0